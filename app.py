@@ -1,22 +1,47 @@
-from flask import Flask, render_template, jsonify, request , send_from_directory
+from flask import Flask, render_template, jsonify, request , send_from_directory, Response
 from flask_cors import CORS
 import os
 import redis
 import json
-from werkzeug.utils import secure_filename
-import datetime
+from werkzeug.utils import secure_filename, safe_join
+import hashlib
+import re
+import tempfile
 import uuid
 import time
 from time import sleep
 import logging
+from command_queue import build_command, build_start_command, enqueue_command, enqueue_commands, migrate_legacy_queues
+from flow_engine import FlowEngine, FlowGraph, FLOW_EVENTS_CHANNEL, prefetch_assets
+import device_registry
+import scenario_catalog
+import image_renderer
+import metrics
+import command_trace
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 
-redis_client = redis.Redis(host='redis', port=6379, decode_responses=True)
+redis_client = metrics.InstrumentedRedis(host='redis', port=6379, decode_responses=True)
+flow_engine = FlowEngine(redis_client)
+render_executor = ThreadPoolExecutor(max_workers=2)
 
+try:
+    migrated = scenario_catalog.migrate_legacy_list(redis_client)
+    if migrated:
+        logger.info(f"Moved {migrated} scenarios from scenarios_list into the catalog")
+except redis.RedisError as e:
+    logger.error(f"Could not migrate the scenario list: {e}")
+
+try:
+    migrated = migrate_legacy_queues(redis_client)
+    if migrated:
+        logger.info(f"Moved {migrated} queued commands from lists into command streams")
+except redis.RedisError as e:
+    logger.error(f"Could not migrate the command queues: {e}")
 
 
 
@@ -24,6 +49,9 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+app.config['RENDER_FOLDER'] = 'static/renders'
+UPLOAD_CHUNK_SIZE = 64 * 1024
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
 
 
 def allowed_file(filename):
@@ -31,6 +59,7 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 CORS(app)
+metrics.init_app(app, redis_client)
 
 CORS(app, resources={
     r"/*": {
@@ -52,11 +81,16 @@ def index():
 
 @app.route('/get_devices', methods=['GET'])
 def get_devices():
+    """Registered devices, each with the `health` the gateway measures (link state, RTT)."""
     try:
-        return json.loads(redis_client.get("connected_devices") or {})
+        devices = device_registry.get_devices(redis_client)
+        health = device_registry.get_health(redis_client, list(devices))
+        for device_id, device_info in devices.items():
+            device_info['health'] = health.get(device_id)
+        return jsonify(devices)
     except Exception as e:
-        print(f"Error getting devices: {e}")
-        return json.dumps({})
+        logger.error(f"Error getting devices: {e}")
+        return jsonify({})
     
     
 @app.route('/delete_scenario/<scenario_name>', methods=['DELETE'])
@@ -64,37 +98,31 @@ def delete_scenario(scenario_name):
     if not scenario_name or scenario_name == 'undefined':
         return jsonify({"error": "Invalid scenario name"}), 400
         
-    flow_data = redis_client.get(f"scenario_{scenario_name}")
-    if not flow_data:
+    if not scenario_catalog.exists(redis_client, scenario_name):
         return jsonify({"error": "Scenario not found"}), 404
         
-    redis_client.delete(f"scenario_{scenario_name}")
-    redis_client.lrem("scenarios_list", 0, scenario_name)
+    scenario_catalog.delete(redis_client, scenario_name)
     return jsonify({"message": "Scenario deleted"}), 200
 
 @app.route('/rename_scenario/<old_name>/<new_name>', methods=['PUT'])
 def rename_scenario(old_name, new_name):
-    flow_data = redis_client.get(f"scenario_{old_name}")
-    if not flow_data:
+    if not scenario_catalog.exists(redis_client, old_name):
         return jsonify({"error": "Scenario not found"}), 404
-    if redis_client.exists(f"scenario_{new_name}"):
+    if scenario_catalog.exists(redis_client, new_name):
         return jsonify({"error": "Scenario with this name already exists"}), 400 
-    redis_client.rename(f"scenario_{old_name}", f"scenario_{new_name}")    
-    redis_client.lrem("scenarios_list", 0, old_name)
-    redis_client.lpush("scenarios_list", new_name)
+    scenario_catalog.rename(redis_client, old_name, new_name)
         
     return jsonify({"message": "Scenario renamed successfully"}), 200
     
 @app.route('/copy_scenario/<original_name>/<new_name>', methods=['POST'])
 def copy_scenario(original_name, new_name):
 
-    flow_data = redis_client.get(f"scenario_{original_name}")
+    flow_data = scenario_catalog.load(redis_client, original_name)
     if not flow_data:
         return jsonify({"error": "scenario not found"}), 404
-    if redis_client.exists(f"scenario_{new_name}"):
+    if scenario_catalog.exists(redis_client, new_name):
         return jsonify({"error": "name already exists"}), 400
-    redis_client.set(f"scenario_{new_name}", flow_data)    
-    redis_client.lpush("scenarios_list", new_name)    
+    scenario_catalog.save(redis_client, new_name, json.dumps(flow_data))
     return jsonify({
         "message": "Scenario copied successfully",  
         "new_name": new_name
@@ -109,11 +137,7 @@ def save_flow():
     if not flow_data:
         return jsonify({'message': 'No data provided'}), 400
 
-
-    redis_client.set(f"scenario_{flow_name}",json.dumps(flow_data))
-    previous_scenario = redis_client.lrange("scenarios_list", 0, -1)
-    if flow_name not in previous_scenario:
-        redis_client.lpush("scenarios_list", flow_name)
+    scenario_catalog.save(redis_client, flow_name, json.dumps(flow_data))
 
     return jsonify({
     'message': 'Flow data received successfully2',
@@ -123,20 +147,41 @@ def save_flow():
 
 @app.route('/flow_scenarios', methods=['GET'])
 def get_scenarios():
+    """
+    Scenario names, most recently modified first.
+    With ?offset=&limit= (and optionally sort=modified|name) returns one page with
+    metadata instead: {'scenarios': [...], 'total': N, 'offset': ..., 'limit': ...}
+    """
     try:
-        return list(set(redis_client.lrange(f"scenarios_list", 0, -1)))
-    except:
-        pass
+        if 'limit' not in request.args and 'offset' not in request.args:
+            return jsonify(scenario_catalog.names(redis_client))
+
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        sort = request.args.get('sort', 'modified')
+        if sort not in scenario_catalog.SORT_ORDERS:
+            return jsonify({'error': f'sort must be one of {", ".join(scenario_catalog.SORT_ORDERS)}'}), 400
+
+        entries, total = scenario_catalog.page(redis_client, offset, limit, sort)
+        return jsonify({
+            'scenarios': entries,
+            'total': total,
+            'offset': offset,
+            'limit': limit
+        })
+    except Exception as e:
+        logger.error(f"Error listing scenarios: {e}")
+        return jsonify({'error': f'Failed to list scenarios: {str(e)}'}), 500
 
 
 @app.route('/load-flow/<flow_id>', methods=['GET'])
 def load_flow(flow_id):
     try:
-        flow_data = redis_client.get(f"scenario_{flow_id}")
+        flow_data = scenario_catalog.load(redis_client, flow_id)
         if not flow_data:
             return jsonify({"error": "Flow not found"}), 404
             
-        return jsonify(json.loads(flow_data))
+        return jsonify(flow_data)
         
     except Exception as e:
         return jsonify({
@@ -147,7 +192,7 @@ def load_flow(flow_id):
 
 @app.route('/reset/<device_id>', methods=['POST'])
 def reset(device_id):
-    redis_client.lpush(f'{device_id}:commands', "reset")
+    enqueue_command(redis_client, device_id, "reset")
     return jsonify({'status': 'success'})
 
 @app.route('/start/<device_id>', methods=['POST'])
@@ -165,41 +210,28 @@ def start(device_id):
         logger.info(f"Starting device {device_id} for node {node_id} in scenario {scenario_name}")
         logger.info(f"Device config: {config}")
 
-        processed_config = {}
-        for key, value in config.items():
-            if value == "null":
-                processed_config[key] = None
-            else:
-                processed_config[key] = value
-        
         redis_client.set(f'{device_id}:current_config', json.dumps(config))
         logger.info(f"Stored config for device {device_id}")
 
-        
-        simple_config = {}
-        for key, value in config.items():
-            if value == "null":
-                simple_config[key] = None  
-            else:
-                simple_config[key] = value
-        
         redis_client.set(f'{device_id}:status', 'in progress')
-        
-        command_data = {
-            'command': 'start',
-            'config': simple_config,
-            'node_id': node_id,
-            'scenario_name': scenario_name
-        }
-        redis_client.lpush(f'{device_id}:commands', json.dumps(command_data))
+        if node_id:
+            # drop the status left by a previous run so /events and /get_status start fresh
+            redis_client.delete(f"flow_execution:{node_id}")
+
+        command_data = build_start_command(node_id, scenario_name, config)
+        simple_config = command_data['config']
+        enqueue_command(redis_client, device_id, command_data)
         
         logger.info(f"Device {device_id} started with command: {command_data}")
+        if node_id and scenario_name:
+            prefetch_next_assets(scenario_name, node_id)
         
         return jsonify({
             'status': 'success',
             'message': f'Device {device_id} started successfully',
             'deviceId': device_id,
             'nodeId': node_id,
+            'traceId': command_data['trace_id'],
             'config': simple_config,
             'device_status': 'in progress'
         })
@@ -216,32 +248,72 @@ def start(device_id):
 
 @app.route('/finish/<device_id>', methods=['POST'])
 def finish(device_id):
-    redis_client.lpush(f'{device_id}:commands', "finish")
+    enqueue_command(redis_client, device_id, "finish")
     return jsonify({'status': 'success'})
 
 @app.route('/hint/<device_id>/<hint_id>', methods=['POST'])
 def send_hint(device_id, hint_id):
-    redis_client.lpush(f'{device_id}:commands', hint_id)
+    enqueue_command(redis_client, device_id, hint_id)
     return jsonify({'status': 'success'})
 
+def prefetch_next_assets(scenario_name, node_id):
+    """Let the devices of the next nodes cache their files while this one runs."""
+    try:
+        flow = scenario_catalog.load(redis_client, scenario_name)
+        if flow:
+            prefetch_assets(redis_client, FlowGraph(flow), [node_id], scenario_name)
+    except Exception as e:
+        logger.error(f"Error prefetching assets after node {node_id}: {e}")
+
+
 @app.route('/start_all', methods=['POST'])
 def start_all():
-    connected_dev = redis_client.get("connected_devices")
-    if connected_dev:
-        devices = json.loads(connected_dev.replace("'", '"'))
-        for device_id in devices.keys():
-            redis_client.lpush(f'{device_id}:commands', "start")
+    device_ids = device_registry.get_device_ids(redis_client)
+    enqueue_commands(redis_client, [(device_id, "start") for device_id in device_ids])
     return jsonify({'status': 'success'})
 
 @app.route('/reset_all', methods=['POST'])
 def reset_all():
-    connected_dev = redis_client.get("connected_devices")
-    if connected_dev:
-        devices = json.loads(connected_dev.replace("'", '"'))
-        for device_id in devices.keys():
-            redis_client.lpush(f'{device_id}:commands', "reset")
+    device_ids = device_registry.get_device_ids(redis_client)
+    enqueue_commands(redis_client, [(device_id, "reset") for device_id in device_ids])
     return jsonify({'status': 'success'})
 
+@app.route('/commands/batch', methods=['POST'])
+def send_commands_batch():
+    """
+    Queue many commands at once, atomically.
+    Expected JSON payload: [{'device_id': ..., 'command': ..., 'config': {...}}, ...]
+    with optional 'nodeId' and 'scenarioName' per entry.
+    """
+    entries = request.get_json(silent=True)
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'Expected a non-empty list of commands'}), 400
+
+    commands = []
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('device_id') or not entry.get('command'):
+            return jsonify({
+                'error': f'Entry {position} needs a device_id and a command'
+            }), 400
+        command = build_command(
+            entry['command'],
+            config=entry.get('config'),
+            node_id=entry.get('nodeId'),
+            scenario_name=entry.get('scenarioName')
+        )
+        commands.append((entry['device_id'], command))
+
+    try:
+        enqueue_commands(redis_client, commands)
+    except Exception as e:
+        logger.error(f"Error queuing command batch: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to queue commands: {str(e)}'
+        }), 500
+
+    return jsonify({'status': 'success', 'queued': len(commands)})
+
 
 @app.route('/set_random_devices', methods=['GET'])
 def save_random_device_config():
@@ -343,8 +415,9 @@ def save_random_device_config():
             }
         },
         }
-    redis_client.set("connected_devices", json.dumps(devices_list))
-    return json.loads(redis_client.get("connected_devices"))
+    for device_id, device_info in devices_list.items():
+        device_registry.register_device(redis_client, device_id, device_info)
+    return jsonify(device_registry.get_devices(redis_client))
 
 
 @app.route('/upload-image', methods=['POST'])
@@ -358,31 +431,17 @@ def upload_image():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        field_name = request.form.get('fieldName', '')
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_filename = f"{field_name}_{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        
-        file.save(filepath)
-        image_url = f"/static/uploads/{unique_filename}"
+        stored_filename = store_upload(file, filename.rsplit('.', 1)[1].lower())
+        image_url = f"/static/uploads/{stored_filename}"
+        prerender_upload(stored_filename)
         
         node_id = request.form.get('nodeId')
         scenario_name = request.form.get('scenarioName')
         field_name = request.form.get('fieldName')
         
         if node_id and scenario_name and field_name:
-            scenario_key = f"scenario_{scenario_name}"
-            scenario_data = redis_client.get(scenario_key)
-            
-            if scenario_data:
-                scenario_data = json.loads(scenario_data)
-                for node in scenario_data.get('nodes', []):
-                    if (node['id'] == node_id and 
-                        'config' in node.get('data', {}) and 
-                        field_name in node['data']['config']):
-                        node['data']['config'][field_name]['value'] = image_url
-                
-                redis_client.set(scenario_key, json.dumps(scenario_data))
+            if scenario_catalog.exists(redis_client, scenario_name):
+                scenario_catalog.set_field(redis_client, scenario_name, node_id, field_name, image_url)
         
         return jsonify({
             'message': 'File uploaded successfully',
@@ -393,9 +452,107 @@ def upload_image():
     return jsonify({'error': 'Invalid file type'}), 400
 
 
+def store_upload(file, extension):
+    """
+    Save an upload under the SHA-256 of its content, so identical files are stored
+    (and cached by browsers and devices) once. Returns the stored file name.
+    """
+    hasher = hashlib.sha256()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    tmp = tempfile.NamedTemporaryFile(dir=upload_folder, delete=False)
+    try:
+        with tmp:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                tmp.write(chunk)
+
+        stored_filename = f"{hasher.hexdigest()}.{extension}"
+        filepath = os.path.join(upload_folder, stored_filename)
+        if os.path.exists(filepath):
+            os.remove(tmp.name)
+        else:
+            # readable by the gateway, which serves the uploads under another uid
+            os.chmod(tmp.name, 0o644)
+            os.replace(tmp.name, filepath)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return stored_filename
+
+
+def display_profiles():
+    """Display profiles declared by the registered devices."""
+    profiles = set()
+    for device_info in device_registry.get_devices(redis_client).values():
+        profile = image_renderer.profile_name(device_info.get('display'))
+        if profile:
+            profiles.add(profile)
+    return profiles
+
+
+def prerender_upload(filename):
+    """Render a new upload for every connected display in the background."""
+    source_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+    def prerender():
+        try:
+            for profile in display_profiles():
+                image_renderer.render(source_path, profile, app.config['RENDER_FOLDER'])
+        except Exception as e:
+            logger.error(f"Error pre-rendering {filename}: {e}")
+
+    render_executor.submit(prerender)
+
+
+@app.route('/render/<profile>/<path:filename>')
+def serve_rendered_file(profile, filename):
+    """
+    An upload rendered for a display profile (e.g. 1872x1404-L), ready to blit.
+    Rendered on first request when it was not pre-rendered at upload time.
+    """
+    try:
+        image_renderer.parse_profile(profile)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    source_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if source_path is None or not os.path.isfile(source_path):
+        return jsonify({'error': 'File not found'}), 404
+    try:
+        rendered = image_renderer.render(source_path, profile, app.config['RENDER_FOLDER'])
+    except Exception as e:
+        logger.error(f"Error rendering {filename} for {profile}: {e}")
+        return jsonify({'error': f'Failed to render image: {str(e)}'}), 500
+
+    folder = os.path.join(app.config['RENDER_FOLDER'], profile)
+    return send_asset(folder, rendered, filename, suffix=f"-{profile}")
+
+
 @app.route('/static/uploads/<path:filename>')
 def serve_uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_asset(app.config['UPLOAD_FOLDER'], filename, filename)
+
+
+def send_asset(folder, filename, upload_name, suffix=''):
+    """
+    Send a stored file with validators, so devices can revalidate their cached copy
+    with If-None-Match / If-Modified-Since and get a 304 instead of the bytes.
+    Content-addressed uploads use their hash (plus `suffix` for renders) as ETag
+    and may be cached forever.
+    """
+    if not CONTENT_ADDRESSED_NAME.match(upload_name):
+        return send_from_directory(folder, filename)
+    # the name is the content hash, so the bytes behind it never change
+    content_hash = upload_name.split('.', 1)[0]
+    response = send_from_directory(
+        folder, filename, max_age=365 * 24 * 3600, etag=content_hash + suffix
+    )
+    response.cache_control.immutable = True
+    return response
 
     
 @app.route('/send_status/<device_id>', methods=['POST'])
@@ -443,7 +600,6 @@ def send_status(device_id):
 def get_status(node_id):
     try:
         status = redis_client.get(f"flow_execution:{node_id}")
-        print(status)
 
         return jsonify({
             'node_id': node_id,
@@ -456,6 +612,80 @@ def get_status(node_id):
             'message': f'Failed to get device status: {str(e)}'
         }), 500
 
+@app.route('/trace/<node_id>', methods=['GET'])
+def get_trace(node_id):
+    """
+    Where the time of a node's commands went: every traced command, most recent
+    first, with its timestamped hops (enqueued, dequeued, sent, acked) and the
+    latency between them.
+    """
+    try:
+        traces = command_trace.get_traces(redis_client, node_id)
+    except Exception as e:
+        logger.error(f"Error reading the trace of node {node_id}: {e}")
+        return jsonify({'error': f'Failed to read trace: {str(e)}'}), 500
+    if not traces:
+        return jsonify({'error': 'No trace for this node'}), 404
+    return jsonify({'node_id': node_id, 'traces': traces})
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    Server-Sent Events stream of node status changes, pushed as the TCP gateway and
+    the flow engine publish them. Use ?scenario=<name> to receive a single scenario.
+    """
+    scenario_name = request.args.get('scenario')
+
+    def stream():
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(FLOW_EVENTS_CHANNEL)
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                message = pubsub.get_message(timeout=15)
+                if message is None:
+                    # comment line, keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                event = json.loads(message['data'])
+                if scenario_name and event.get('scenario') != scenario_name:
+                    continue
+                yield f"event: status\ndata: {message['data']}\n\n"
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@app.route('/run/<scenario_name>', methods=['POST'])
+def run_scenario(scenario_name):
+    """Run a saved scenario on the backend; poll GET /run/<run_id> for its progress."""
+    try:
+        run = flow_engine.start(scenario_name)
+    except KeyError:
+        return jsonify({"error": "Scenario not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": f"Scenario cannot run: {e}"}), 400
+
+    logger.info(f"Scenario {scenario_name} running as {run.run_id}")
+    return jsonify(run.to_dict()), 202
+
+@app.route('/run/<run_id>', methods=['GET'])
+def get_run(run_id):
+    run = flow_engine.get(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    return jsonify(run)
+
+@app.route('/run/<run_id>', methods=['DELETE'])
+def stop_run(run_id):
+    if not flow_engine.stop(run_id):
+        return jsonify({"error": "Run not found or already finished"}), 404
+    return jsonify({'status': 'success', 'run_id': run_id})
+
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -1,23 +1,132 @@
 from IT8951.display import AutoEPDDisplay
 from IT8951 import constants
 from PIL import Image
+import numpy as np
 
-def main(image_path):
+# Partial refreshes leave ghosting behind; after this many, or once they covered
+# this many screens worth of area, the next image gets a full GC16 refresh
+GHOSTING_BUDGET_UPDATES = 20
+GHOSTING_BUDGET_AREA = 2.0
+# Changes covering more of the panel than this are drawn with a full refresh anyway
+PARTIAL_MAX_AREA = 0.5
+# More separate changed regions than this are merged into their bounding box
+MAX_BOXES = 8
+# Rows closer than this are refreshed as one box
+BOX_GAP = 16
+
+_display = None
+
+
+class EPaperDisplay():
+    """
+    Long-lived e-paper driver. It keeps the frame on the panel, refreshes only the
+    boxes that changed with partial-update waveforms (DU when the new pixels are
+    pure black and white, GL16 otherwise) and does a full refresh on the first
+    image, on large changes, and when the ghosting budget is used up.
+
+    `epd` is an IT8951 AutoDisplay, or anything with width, height, frame_buf,
+    draw_full(mode) and draw_partial(mode).
+    """
+
+    def __init__(self, epd):
+        self.epd = epd
+        self.width = epd.width
+        self.height = epd.height
+        self.last = None  # numpy copy of the frame on the panel
+        self.partial_updates = 0
+        self.partial_area = 0.0
+
+    def show(self, img):
+        """Display a PIL image; returns the list of (box, mode) refreshes done."""
+        if img.mode != "L" or img.size != (self.width, self.height):
+            img = img.convert("L").resize((self.width, self.height))
+        frame = np.asarray(img)
+
+        if self.last is None:
+            return self.full_refresh(img, frame)
+        boxes = changed_boxes(self.last, frame)
+        if not boxes:
+            return []
+        area = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+        area /= self.width * self.height
+        if (area > PARTIAL_MAX_AREA
+                or self.partial_updates >= GHOSTING_BUDGET_UPDATES
+                or self.partial_area + area > GHOSTING_BUDGET_AREA):
+            return self.full_refresh(img, frame)
 
-    # Init display (using spidev, no GPIO base needed)
-    epd = AutoEPDDisplay(vcom=-1.45)
+        refreshes = []
+        for box in boxes:
+            left, top, right, bottom = box
+            region = frame[top:bottom, left:right]
+            bw = bool(np.isin(region, (0, 255)).all())
+            mode = constants.DisplayModes.DU if bw else constants.DisplayModes.GL16
+            # the driver refreshes the box bounding what changed in frame_buf
+            self.epd.frame_buf.paste(img.crop(box), (left, top))
+            self.epd.draw_partial(mode)
+            refreshes.append((box, mode))
+        self.partial_updates += 1
+        self.partial_area += area
+        self.last = frame.copy()
+        return refreshes
 
-    # Load and convert image
-    img = Image.open(image_path).convert("L").resize((epd.width, epd.height))
+    def full_refresh(self, img, frame=None):
+        self.epd.frame_buf.paste(img, (0, 0))
+        self.epd.draw_full(constants.DisplayModes.GC16)
+        self.last = (frame if frame is not None else np.asarray(img)).copy()
+        self.partial_updates = 0
+        self.partial_area = 0.0
+        return [((0, 0, self.width, self.height), constants.DisplayModes.GC16)]
 
-    # Draw grayscale image
-    epd.frame_buf.paste(img, (0, 0))
-    epd.draw_full(constants.DisplayModes.GC16)
 
-    # Fast B/W mode test
-    bw_img = img.convert("1")
-    epd.frame_buf.paste(bw_img, (0, 0))
-    epd.draw_full(constants.DisplayModes.A2)
+def changed_boxes(previous, frame):
+    """
+    Boxes (left, top, right, bottom) covering the pixels that differ between two
+    equally sized grayscale frames: one per band of changed rows.
+    """
+    changed = previous != frame
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not len(rows):
+        return []
+    bands = []
+    start = prev = rows[0]
+    for row in rows[1:]:
+        if row - prev > BOX_GAP:
+            bands.append((start, prev + 1))
+            start = row
+        prev = row
+    bands.append((start, prev + 1))
+
+    boxes = []
+    for top, bottom in bands:
+        columns = np.flatnonzero(changed[top:bottom].any(axis=0))
+        boxes.append((int(columns[0]), int(top), int(columns[-1]) + 1, int(bottom)))
+    if len(boxes) > MAX_BOXES:
+        boxes = [(
+            min(box[0] for box in boxes), boxes[0][1],
+            max(box[2] for box in boxes), boxes[-1][3]
+        )]
+    return boxes
+
+
+def get_display():
+    """Init the display once (using spidev, no GPIO base needed) and reuse it"""
+    global _display
+    if _display is None:
+        _display = EPaperDisplay(AutoEPDDisplay(vcom=-1.45))
+    return _display
+
+
+def display_profile():
+    """Display profile the backend pre-renders images for (8-bit grayscale, panel size)"""
+    display = get_display()
+    return {"width": display.width, "height": display.height, "format": "L"}
+
+
+def main(image_path):
+    # Conversion is skipped when the backend already rendered the image for this
+    # panel, and only the parts that changed since the last image are refreshed
+    with Image.open(image_path) as img:
+        get_display().show(img)
 
 if __name__ == "__main__":
     main()
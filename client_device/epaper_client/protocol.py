@@ -0,0 +1,143 @@
+"""
+Framed device protocol shared by the TCP gateway and the device clients.
+
+Every message is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON.
+A message with "type": "file" is a header announcing `size` raw bytes that follow it
+directly on the stream (the JSON header + raw bytes scheme of send_file); the
+gateway also puts their "sha256" in the header.
+
+Keep the copies in tcp_server/ and client_device/*/ identical (test_shared_modules.py
+checks).
+"""
+import json
+import struct
+
+HEADER = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # largest JSON message accepted
+CHUNK_SIZE = 64 * 1024               # read/write size for raw file bytes
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_message(message):
+    """Serialize a message into one length-prefixed frame."""
+    payload = json.dumps(message).encode("utf-8")
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"message of {len(payload)} bytes exceeds {MAX_MESSAGE_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_payload(payload):
+    try:
+        return json.loads(payload.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError(f"invalid message: {e}")
+
+
+class MessageParser():
+    """
+    Incremental frame parser: feed it bytes as they arrive, in any chunking,
+    and it hands back every complete message.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def append(self, data):
+        self._buffer += data
+
+    def feed(self, data):
+        self.append(data)
+        messages = []
+        while True:
+            message = self.next_message()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def next_message(self):
+        """Pop one complete message from the buffer, or None if it is not all there yet."""
+        if len(self._buffer) < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self._buffer)
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"message of {length} bytes exceeds {MAX_MESSAGE_SIZE}")
+        end = HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        payload = bytes(self._buffer[HEADER.size:end])
+        del self._buffer[:end]
+        return decode_payload(payload)
+
+    def take(self, size):
+        """Pop up to `size` already buffered bytes (raw file data following a header)."""
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class FramedSocket():
+    """Blocking socket wrapper speaking the framed protocol (device side)."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = MessageParser()
+
+    def send(self, message):
+        self.sock.sendall(encode_message(message))
+
+    def send_file(self, header, data):
+        """Send a "file" header followed by the raw bytes."""
+        header = dict(header, type="file", size=len(data))
+        self.sock.sendall(encode_message(header))
+        self.sock.sendall(data)
+
+    def recv(self):
+        """Block until a whole message arrived; returns None once the peer closed."""
+        while True:
+            message = self.parser.next_message()
+            if message is not None:
+                return message
+            data = self.sock.recv(CHUNK_SIZE)
+            if not data:
+                return None
+            self.parser.append(data)
+
+    def recv_file(self, size, fileobj, hasher=None):
+        """
+        Copy the `size` raw bytes following a file header into fileobj, feeding
+        them to `hasher` (a hashlib object) on the way if one is given.
+        """
+        remaining = size
+        data = self.parser.take(remaining)
+        while True:
+            if data:
+                fileobj.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                remaining -= len(data)
+            if remaining <= 0:
+                return
+            data = self.sock.recv(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise ProtocolError(f"connection closed with {remaining} bytes of file missing")
+
+
+async def read_message(reader):
+    """Read one message from an asyncio StreamReader; returns None once the peer closed."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except EOFError:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"message of {length} bytes exceeds {MAX_MESSAGE_SIZE}")
+    return decode_payload(await reader.readexactly(length))
+
+
+async def write_message(writer, message):
+    """Write one message to an asyncio StreamWriter and wait for the buffer to drain."""
+    writer.write(encode_message(message))
+    await writer.drain()
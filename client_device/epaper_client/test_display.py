@@ -0,0 +1,146 @@
+"""
+Tests of the partial-refresh logic of EPaperDisplay against a fake panel; run
+with `python -m pytest` from this directory. The IT8951 driver is only needed
+on the device, so a minimal stand-in is installed when it is missing.
+"""
+import sys
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+try:
+    from IT8951 import constants
+except ImportError:
+    constants = types.ModuleType("IT8951.constants")
+    constants.DisplayModes = types.SimpleNamespace(GC16="GC16", DU="DU", GL16="GL16")
+    driver = types.ModuleType("IT8951.display")
+    driver.AutoEPDDisplay = None
+    package = types.ModuleType("IT8951")
+    package.constants, package.display = constants, driver
+    sys.modules.update({"IT8951": package, "IT8951.constants": constants, "IT8951.display": driver})
+
+import display
+from display import EPaperDisplay, changed_boxes
+
+WIDTH, HEIGHT = 64, 48
+GRAY = 128
+
+
+class FakeEPD():
+    """Panel recording the refreshes it is asked for."""
+
+    def __init__(self):
+        self.width, self.height = WIDTH, HEIGHT
+        self.frame_buf = Image.new("L", (WIDTH, HEIGHT), 255)
+        self.draws = []
+
+    def draw_full(self, mode):
+        self.draws.append(("full", mode))
+
+    def draw_partial(self, mode):
+        self.draws.append(("partial", mode))
+
+
+def blank():
+    return np.full((HEIGHT, WIDTH), 255, dtype=np.uint8)
+
+
+def image(frame):
+    return Image.fromarray(frame)
+
+
+@pytest.fixture
+def panel():
+    epd = FakeEPD()
+    screen = EPaperDisplay(epd)
+    screen.show(image(blank()))
+    epd.draws.clear()
+    return epd, screen
+
+
+def test_first_image_is_a_full_gc16_refresh():
+    epd = FakeEPD()
+    refreshes = EPaperDisplay(epd).show(image(blank()))
+    assert refreshes == [((0, 0, WIDTH, HEIGHT), constants.DisplayModes.GC16)]
+    assert epd.draws == [("full", constants.DisplayModes.GC16)]
+
+
+def test_unchanged_image_refreshes_nothing(panel):
+    epd, screen = panel
+    assert screen.show(image(blank())) == []
+    assert epd.draws == []
+
+
+def test_black_and_white_change_uses_du(panel):
+    epd, screen = panel
+    frame = blank()
+    frame[10:20, 5:15] = 0
+    refreshes = screen.show(image(frame))
+    assert refreshes == [((5, 10, 15, 20), constants.DisplayModes.DU)]
+    assert epd.draws == [("partial", constants.DisplayModes.DU)]
+    assert np.array_equal(np.asarray(epd.frame_buf), frame)
+
+
+def test_gray_change_uses_gl16(panel):
+    epd, screen = panel
+    frame = blank()
+    frame[10:20, 5:15] = GRAY
+    assert screen.show(image(frame)) == [((5, 10, 15, 20), constants.DisplayModes.GL16)]
+    assert epd.draws == [("partial", constants.DisplayModes.GL16)]
+
+
+def test_bands_of_changed_rows_get_a_box_each():
+    previous = blank()
+    frame = blank()
+    frame[2:4, 10:20] = 0
+    frame[30:32, 40:50] = 0
+    assert changed_boxes(previous, frame) == [(10, 2, 20, 4), (40, 30, 50, 32)]
+
+
+def test_boxes_past_max_boxes_merge_into_their_bounding_box(monkeypatch):
+    monkeypatch.setattr(display, "BOX_GAP", 1)
+    monkeypatch.setattr(display, "MAX_BOXES", 3)
+    previous = blank()
+    frame = blank()
+    for i in range(4):
+        frame[4 + 10 * i, 3 + i:10 + i] = 0
+    assert changed_boxes(previous, frame) == [(3, 4, 13, 35)]
+
+
+def test_large_change_is_a_full_refresh(panel):
+    epd, screen = panel
+    frame = blank()
+    frame[:, :WIDTH * 3 // 4] = 0
+    screen.show(image(frame))
+    assert epd.draws == [("full", constants.DisplayModes.GC16)]
+
+
+def test_ghosting_budget_forces_a_full_refresh(panel):
+    epd, screen = panel
+    frame = blank()
+    for i in range(display.GHOSTING_BUDGET_UPDATES):
+        frame[0, i] = 0
+        screen.show(image(frame))
+    assert epd.draws == [("partial", constants.DisplayModes.DU)] * display.GHOSTING_BUDGET_UPDATES
+
+    epd.draws.clear()
+    frame[1, 0] = 0
+    screen.show(image(frame))
+    assert epd.draws == [("full", constants.DisplayModes.GC16)]
+    # the budget starts over after the full refresh
+    frame[2, 0] = 0
+    screen.show(image(frame))
+    assert epd.draws[-1] == ("partial", constants.DisplayModes.DU)
+
+
+def test_ghosting_area_budget_forces_a_full_refresh(panel, monkeypatch):
+    monkeypatch.setattr(display, "GHOSTING_BUDGET_AREA", 0.5)
+    epd, screen = panel
+    frame = blank()
+    frame[:HEIGHT // 3] = 0       # a third of the panel
+    screen.show(image(frame))
+    frame[:HEIGHT // 3] = 255     # the same third back
+    screen.show(image(frame))
+    assert [kind for kind, _ in epd.draws] == ["partial", "full"]
@@ -0,0 +1,171 @@
+"""
+Device-side asset cache shared by the device clients.
+
+Assets are stored under the name of their upload. Uploads are content-addressed
+(<sha256>.<ext>), so a cached copy of one is valid forever and is used without
+any network request; other files are revalidated with a conditional GET. The
+cache stays under a disk budget by evicting the least recently used files.
+
+Keep the copies in client_device/*/ identical (test_shared_modules.py checks).
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+
+CACHE_DIR = "assets"
+CACHE_BUDGET = int(os.getenv("DEVICE_ASSET_CACHE_MB", 256)) * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+CONTENT_ADDRESSED_NAME = re.compile(r'^([0-9a-f]{64})\.[a-z0-9]+$')
+INDEX_FILE = "index.json"
+
+
+class AssetCache():
+
+    def __init__(self, directory=CACHE_DIR, budget=CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+        # guards the index: files are pushed by the socket loop while commands read
+        self._lock = threading.RLock()
+        # name -> {"size", "etag", "last_modified", "last_used"}
+        self.entries = self._load_index()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def names(self):
+        """Names of the cached content-addressed assets (never stale)."""
+        with self._lock:
+            return sorted(name for name in self.entries if CONTENT_ADDRESSED_NAME.match(name))
+
+    def lookup(self, url):
+        """Path of a cached asset that needs no revalidation, or None."""
+        name = os.path.basename(url or "")
+        with self._lock:
+            if name in self.entries and CONTENT_ADDRESSED_NAME.match(name):
+                self.touch(name)
+                return self.path(name)
+        return None
+
+    def fetch(self, base_url, url, sources=None):
+        """
+        Path of the asset behind an upload URL, downloaded only when it is not
+        cached or changed. `sources` are the URLs to try in order (e.g. a
+        render for this display, then the upload itself); defaults to [url].
+        """
+        path = self.lookup(url)
+        if path:
+            return path
+        name = os.path.basename(url)
+        with self._lock:
+            entry = dict(self.entries.get(name) or {}) or None
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        error = None
+        for source in sources or [url]:
+            try:
+                response = requests.get(base_url + source, headers=headers, stream=True, timeout=30)
+            except requests.RequestException as e:
+                error = e
+                continue
+            with response:
+                if response.status_code == 304 and entry:
+                    self.touch(name)
+                    return self.path(name)
+                if response.status_code != 200:
+                    error = Exception(f"GET {source}: HTTP {response.status_code}")
+                    continue
+                etag = response.headers.get("ETag")
+                match = CONTENT_ADDRESSED_NAME.match(name)
+                # uploads are served with their content hash as ETag, renders are not
+                expected = match.group(1) if match and etag and etag.strip('"') == match.group(1) else None
+                return self.store(
+                    name,
+                    lambda f, hasher: self._copy(response, f, hasher),
+                    expected_sha256=expected,
+                    etag=etag,
+                    last_modified=response.headers.get("Last-Modified")
+                )
+        raise error or Exception(f"GET {url} failed")
+
+    def store(self, name, write, expected_sha256=None, etag=None, last_modified=None):
+        """
+        Add an asset: `write(fileobj, hasher)` writes its bytes. The file only
+        replaces the cached one once complete and, if `expected_sha256` is given,
+        verified. Returns its path, or raises ValueError on a hash mismatch.
+        """
+        name = os.path.basename(name)
+        path = self.path(name)
+        # a concurrent download of the same asset writes its own temporary file
+        tmp_path = f"{path}.part.{threading.get_ident()}"
+        hasher = hashlib.sha256()
+        with open(tmp_path, "wb") as f:
+            write(f, hasher)
+        if expected_sha256 and hasher.hexdigest() != expected_sha256:
+            os.remove(tmp_path)
+            raise ValueError(f"{name}: content does not match its hash")
+        with self._lock:
+            os.replace(tmp_path, path)
+            self.entries[name] = {
+                "size": os.path.getsize(path),
+                "etag": etag,
+                "last_modified": last_modified,
+                "last_used": time.time()
+            }
+            self._evict(keep=name)
+            self._save_index()
+        return path
+
+    def touch(self, name):
+        with self._lock:
+            if name in self.entries:
+                self.entries[name]["last_used"] = time.time()
+                self._save_index()
+
+    def _evict(self, keep):
+        """Remove least recently used assets until the cache fits its budget."""
+        total = sum(entry["size"] for entry in self.entries.values())
+        for name in sorted(self.entries, key=lambda n: self.entries[n]["last_used"]):
+            if total <= self.budget:
+                break
+            if name == keep:
+                continue
+            total -= self.entries.pop(name)["size"]
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+            print(f"[cache] Evicted {name}")
+
+    @staticmethod
+    def _copy(response, fileobj, hasher):
+        for chunk in response.iter_content(CHUNK_SIZE):
+            fileobj.write(chunk)
+            hasher.update(chunk)
+
+    def _load_index(self):
+        try:
+            with open(self.path(INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        # files removed behind our back are no longer cached
+        return {
+            name: entry for name, entry in entries.items()
+            if os.path.isfile(self.path(name))
+        }
+
+    def _save_index(self):
+        tmp_path = self.path(INDEX_FILE + ".part")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path(INDEX_FILE))
@@ -1,10 +1,14 @@
 import socket
-import json
-import requests
+from protocol import FramedSocket
+from asset_cache import AssetCache
+from device_runtime import DeviceRuntime, LINK_TIMEOUT, device_uid, link_timeout, reconnect_delays
+from splash import get_screen_resolution
 #from display import main as display_img
 from splash import cast as display_img 
+from splash import preload as preload_img
 #from splash import show as display_img 
 import time
+import os
 
 class GeniricDevice():
     HOST = "192.168.16.240"  # The server's hostname or IP address
@@ -21,23 +25,58 @@ class GeniricDevice():
                     'type' : 'file',
                     'accept' : 'image/*',
                 }
-            }
+            },
+            # lets the backend send images already scaled and converted for this screen
+            "display": self.get_display()
         }
+        # stable identity: resumes the gateway session after a reconnect
+        self.device_info["device_uid"] = device_uid()
+        if os.getenv("DEVICE_REGISTRY_ID"):
+            # pinned registry id, instead of one following the device's address
+            self.device_info["device_id"] = os.getenv("DEVICE_REGISTRY_ID")
+        self.cache = AssetCache()
+        self.runtime = DeviceRuntime(self)
+        self.redirect = None  # (host, port) of the gateway owning this device, for the next connect
+
+    def get_display(self):
+        try:
+            screen_w, screen_h = get_screen_resolution()
+            return {"width": screen_w, "height": screen_h, "format": "RGB"}
+        except Exception as e:
+            print(f"[!] Display profile unavailable: {e}")
+            return None
+
+    def image_url(self, upload_url):
+        """URL of the upload rendered for this display, or the original upload"""
+        display = self.device_info.get("display")
+        prefix = "/static/uploads/"
+        if not display or not upload_url.startswith(prefix):
+            return upload_url
+        profile = f"{display['width']}x{display['height']}-{display['format']}"
+        return f"/render/{profile}/{upload_url[len(prefix):]}"
 
     # ---- Device State Control ----
-    def start(self, config):
-        
-        
+    def start(self, config, report=None):
+        report = report or (lambda **progress: None)
         backend_url = f"http://{self.HOST}:{self.BACKEND_PORT}"
         image_url = config["image1"]
-        response = requests.get(backend_url+image_url)
-        image_data = response.content
-        with open("image.png", "wb") as f:
-            f.write(image_data)
-        display_img("image.png",time.strftime("%H:%M:%S"),300)
+        # cached copies are used as is, pushed by the gateway or downloaded once
+        report(stage="fetching", asset=image_url)
+        image_path = self.cache.fetch(backend_url, image_url, [self.image_url(image_url), image_url])
+        report(stage="displaying")
+        display_img(image_path,time.strftime("%H:%M:%S"),300)
         self.device_info["status"] = "completed"
             
 
+    def prefetch(self, config):
+        """Cache the files of an upcoming start (usually already pushed by the gateway)"""
+        backend_url = f"http://{self.HOST}:{self.BACKEND_PORT}"
+        for url in config.values():
+            try:
+                preload_img(self.cache.fetch(backend_url, url, [self.image_url(url), url]))
+            except Exception as e:
+                print(f"[!] Prefetch of {url} failed: {e}")
+
     def stop(self):
         self.device_info["status"] = "inactive"
 
@@ -60,31 +99,72 @@ class GeniricDevice():
     def hint10(self): print("[Hint10 executed]")
 
     # ---- Main Socket Loop ----
-    def connect(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.HOST, self.PORT))
-            print(f"[-] Device connected {self.device_info}")
-            s.sendall(json.dumps(self.device_info).encode("utf-8"))
+    def run(self):
+        """Stay connected: reconnect with jittered backoff whenever the connection drops"""
+        delays = reconnect_delays()
+        try:
             while True:
                 try:
-                    data = s.recv(1024).decode("utf-8")
-                    print(data)
-                    if not data:
+                    if self.connect():
+                        delays = reconnect_delays()  # it was up, the next drop starts over
+                except OSError as e:
+                    print(f"[!] Connection failed: {e}")
+                if self.redirect:
+                    continue  # go to the owning gateway right away
+                delay = next(delays)
+                print(f"Reconnecting in {delay:.1f} s")
+                time.sleep(delay)
+        finally:
+            # the runtime outlives connections; its workers stop with the client
+            self.runtime.close()
+
+    def connect(self):
+        """Serve one connection until it drops; returns True if it was established"""
+        # a redirect is followed once; if that fails the configured gateway places us again
+        address = self.redirect or (self.HOST, self.PORT)
+        redirected = self.redirect is not None
+        self.redirect = None
+        with socket.create_connection(address) as s:
+            # the gateway pings regularly, silence means the link is gone
+            s.settimeout(LINK_TIMEOUT)
+            conn = FramedSocket(s)
+            # assets already cached are not pushed again
+            self.runtime.attach(
+                conn, dict(self.device_info, cached_assets=self.cache.names(), redirected=redirected)
+            )
+            print(f"[-] Device connected {self.device_info}")
+            try:
+                while True:
+                    data = conn.recv()
+                    if data is None:
                         print("Connection closed by server.")
                         break
-                    data = json.loads(data)
-                    print(f"New Command: {data['command']}, : {data['node_id']}")
-                    self.execute_command(data["command"], data["config"])
-                    time.sleep(5)
-                    s.sendall(json.dumps({"node_id":data['node_id'], "status": "success"}).encode("utf-8")) 
-                except Exception as e:
-                    print(f"[CLIENT ERROR] {e}")
-                    s.sendall(json.dumps({"status": "error"}).encode("utf-8")) 
-                    break
+                    if data.get("type") == "ping":
+                        self.runtime.pong(data)
+                        s.settimeout(link_timeout(data))
+                        continue
+                    if data.get("type") == "redirect":
+                        # another gateway owns this device; acks sent in the hello are
+                        # sent again when the owner re-sends their commands
+                        print(f"Redirected to gateway {data.get('gateway_id')}")
+                        self.redirect = (data["host"], data["port"])
+                        break
+                    if data.get("type") == "file":
+                        self.receive_file(conn, data)
+                        continue
+                    # executed on a worker, the loop keeps receiving hints and resets
+                    self.runtime.submit(data)
+            except Exception as e:
+                print(f"[CLIENT ERROR] {e}")
+            finally:
+                self.runtime.detach()
+            return True
 
-    def execute_command(self, cmd, config):
+    def execute_command(self, cmd, config, report=None):
         if cmd == "start":
-            self.start(config)
+            self.start(config, report)
+        elif cmd == "prefetch":
+            self.prefetch(config)
         elif cmd == "reset":
             self.reset()
         elif cmd == "finish":
@@ -99,23 +179,22 @@ class GeniricDevice():
         # Always update status with last executed command
         self.device_info["last_command"] = cmd
 
-    def receive_file(self, s, header):
-        """Receive file sent from the server"""
-        filename = header["filename"]
+    def receive_file(self, conn, header):
+        """Receive file sent from the server into the asset cache, checking its hash"""
         filesize = header["size"]
-
-        with open(filename, "wb") as f:
-            remaining = filesize
-            while remaining > 0:
-                chunk = s.recv(min(1024, remaining))
-                if not chunk:
-                    break
-                f.write(chunk)
-                remaining -= len(chunk)
+        try:
+            self.cache.store(
+                header["filename"],
+                lambda f, hasher: conn.recv_file(filesize, f, hasher),
+                expected_sha256=header.get("sha256")
+            )
+        except ValueError as e:
+            # start() will download the file instead
+            print(f"[!] Discarded pushed file: {e}")
 
 if __name__ == "__main__":
     DEVIC_NAME = "Monitor_"
     N_HINTS = 2
     device = GeniricDevice(DEVIC_NAME, N_HINTS)
-    device.connect()
+    device.run()
     
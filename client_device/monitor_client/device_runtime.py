@@ -0,0 +1,180 @@
+"""
+Command runtime shared by the device clients.
+
+The socket loop only receives: every command is handed to a worker and acked as
+soon as its work is done, while the loop keeps reading. The starts of each
+sub-node run one at a time in order, while the sub-nodes of a multi-node device
+run theirs concurrently; prefetches have their own lane so they never hold a
+start back, and hints, resets and other short commands run concurrently with all. A command can
+report progress while it runs; each report is sent to the gateway as a
+{"type": "progress"} message carrying the command_id. Acks carry the time the
+command waited for its worker and the time it ran, for the command traces.
+
+Heartbeat pings from the gateway are answered directly by the receiving thread.
+The runtime outlives connections. Acks that cannot be sent while the device is
+disconnected are kept and handed over in the next hello, together with the
+commands still running, and a command received again after a reconnect is
+acked again instead of being executed twice.
+
+Keep the copies in client_device/*/ identical (test_shared_modules.py checks).
+"""
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CONTROL_WORKERS = 4
+# commands with a lane of their own, executed one at a time in arrival order
+SERIAL_LANES = {"start": "start", "prefetch": "prefetch"}
+# lanes split per sub-node, keyed by the index the gateway adds to every command
+PER_NODE_LANES = {"start"}
+# command ids remembered to recognize commands sent again after a reconnect
+MAX_REMEMBERED_COMMANDS = 256
+# reconnect delays: exponential backoff from RECONNECT_MIN to RECONNECT_MAX seconds,
+# each wait drawn at random below the current delay so devices do not reconnect in step
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30
+# seconds without any message from the gateway, which pings every few seconds,
+# before the connection is considered dead; replaced by link_timeout() of the
+# first ping, which carries the gateway's heartbeat settings
+LINK_TIMEOUT = 30
+HEARTBEAT_MISSES = 3  # gateways that do not send theirs drop a device after as many
+
+
+class DeviceRuntime():
+
+    def __init__(self, device):
+        self.device = device
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.lanes = {}  # lane key -> single-worker executor, created on first use
+        self.control = ThreadPoolExecutor(max_workers=CONTROL_WORKERS, thread_name_prefix="control")
+        # command_id -> its ack, or None while it runs
+        self.commands = OrderedDict()
+        self.pending_acks = []  # acks not delivered because the connection was down
+
+    def attach(self, conn, device_info):
+        """Start serving a new connection: send the hello with the session state."""
+        with self.send_lock:
+            running = [command_id for command_id, ack in self.commands.items() if ack is None]
+            conn.send(dict(device_info, acks=self.pending_acks, running=running))
+            self.pending_acks = []
+            self.conn = conn
+
+    def detach(self):
+        with self.send_lock:
+            self.conn = None
+
+    def pong(self, ping):
+        """Answer a gateway heartbeat right away, from the receiving thread."""
+        self.send({"type": "pong", "seq": ping.get("seq")})
+
+    def submit(self, data):
+        """Queue a received command for execution; returns immediately."""
+        command_id = data.get("command_id")
+        with self.send_lock:
+            if command_id in self.commands:
+                ack = self.commands[command_id]
+                if ack is not None:
+                    # executed already, its ack was lost with the old connection
+                    self._send(ack)
+                return
+            if command_id is not None:
+                self.commands[command_id] = None
+                while len(self.commands) > MAX_REMEMBERED_COMMANDS:
+                    self.commands.popitem(last=False)
+        self.lane(data).submit(self.run, data, time.monotonic())
+
+    def lane(self, data):
+        """The executor a command runs on."""
+        lane = SERIAL_LANES.get(data.get("command"))
+        if lane is None:
+            return self.control
+        key = (lane, data.get("index")) if lane in PER_NODE_LANES else (lane, None)
+        if key not in self.lanes:
+            name = lane if key[1] is None else f"{lane}-{key[1]}"
+            self.lanes[key] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-lane")
+        return self.lanes[key]
+
+    def run(self, data, received=None):
+        command_id = data.get("command_id")
+        started = time.monotonic()
+
+        def report(**progress):
+            self.send(dict(progress, type="progress", command_id=command_id, node_id=data.get("node_id")))
+
+        try:
+            print(f"New Command: {data['command']}, : {data.get('node_id')}")
+            self.device.execute_command(data["command"], data.get("config") or {}, report)
+            ack = {"node_id": data.get("node_id"), "command_id": command_id, "status": "success"}
+        except Exception as e:
+            print(f"[CLIENT ERROR] {e}")
+            ack = {"node_id": data.get("node_id"), "command_id": command_id,
+                   "status": "error", "error": str(e)}
+        finished = time.monotonic()
+        ack["timing"] = {
+            "wait_ms": round((started - (received or started)) * 1000, 2),
+            "run_ms": round((finished - started) * 1000, 2)
+        }
+        with self.send_lock:
+            if command_id in self.commands:
+                self.commands[command_id] = ack
+            if not self._send(ack):
+                self.pending_acks.append(ack)
+
+    def send(self, message):
+        """Send from any worker; returns False if there is no connection to send on."""
+        with self.send_lock:
+            return self._send(message)
+
+    def _send(self, message):
+        if self.conn is None:
+            return False
+        try:
+            self.conn.send(message)
+            return True
+        except OSError as e:
+            print(f"[!] Send failed: {e}")
+            self.conn = None
+            return False
+
+    def close(self, wait=False):
+        """Stop the workers when the client exits; commands not started are dropped."""
+        for executor in list(self.lanes.values()) + [self.control]:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def link_timeout(ping):
+    """
+    Read timeout matching the heartbeat of the gateway that sent `ping`: it gives
+    up on the device after `misses` unanswered pings, one every `interval` seconds.
+    """
+    interval = ping.get("interval")
+    if not interval:
+        return LINK_TIMEOUT
+    return interval * (ping.get("misses", HEARTBEAT_MISSES) + 1)
+
+
+def reconnect_delays():
+    """Waits between connection attempts: full jitter over an exponential backoff."""
+    delay = RECONNECT_MIN
+    while True:
+        yield random.uniform(0, delay)
+        delay = min(delay * 2, RECONNECT_MAX)
+
+
+def device_uid(path="device_uid"):
+    """Identity of this device across reconnects and restarts, kept in a file."""
+    try:
+        with open(path) as f:
+            uid = f.read().strip()
+        if uid:
+            return uid
+    except OSError:
+        pass
+    uid = uuid.uuid4().hex
+    with open(path, "w") as f:
+        f.write(uid)
+    return uid
@@ -0,0 +1,147 @@
+"""
+Direct framebuffer output for the monitor client.
+
+The framebuffer is mmapped once and its geometry read once. Frames are converted
+to the framebuffer pixel format into preallocated buffers, compared with the
+frame on screen, and only the rectangles that changed are copied into the
+mapping, so redrawing a text overlay over the same image writes a few kilobytes
+instead of the whole screen. Any regular file of the right size can stand in for /dev/fb0.
+"""
+import mmap
+import os
+from collections import namedtuple
+
+import numpy as np
+
+FB_DEVICE = "/dev/fb0"
+SYSFS_FB = "/sys/class/graphics/fb0"
+DEFAULT_GEOMETRY = (800, 480, 16)  # used when neither sysfs nor fbset answer
+
+Geometry = namedtuple("Geometry", "width height bits_per_pixel stride")
+
+_geometry = None
+
+
+def screen_geometry():
+    """Geometry of fb0, read from sysfs (or fbset) on the first call only."""
+    global _geometry
+    if _geometry is None:
+        _geometry = _read_geometry()
+    return _geometry
+
+
+def _read_geometry():
+    try:
+        with open(os.path.join(SYSFS_FB, "virtual_size")) as f:
+            width, height = (int(v) for v in f.read().strip().split(","))
+        with open(os.path.join(SYSFS_FB, "bits_per_pixel")) as f:
+            bits_per_pixel = int(f.read())
+        with open(os.path.join(SYSFS_FB, "stride")) as f:
+            stride = int(f.read())
+        return Geometry(width, height, bits_per_pixel, stride)
+    except (OSError, ValueError):
+        pass
+    try:
+        output = os.popen("fbset -s | grep geometry").read()
+        _, w, h, _, _, bpp = output.split()[:6]
+        width, height, bits_per_pixel = int(w), int(h), int(bpp)
+    except ValueError:
+        print("fbset is missing")
+        width, height, bits_per_pixel = DEFAULT_GEOMETRY
+    return Geometry(width, height, bits_per_pixel, width * bits_per_pixel // 8)
+
+
+class Framebuffer():
+    """
+    Writes RGB frames to a framebuffer device (16-bit RGB565 or 32-bit XRGB8888).
+    """
+
+    def __init__(self, path=FB_DEVICE, geometry=None):
+        self.geometry = geometry or screen_geometry()
+        width, height, bits_per_pixel, stride = self.geometry
+        if bits_per_pixel == 16:
+            dtype = np.dtype("<u2")
+        elif bits_per_pixel == 32:
+            dtype = np.dtype("<u4")
+        else:
+            raise ValueError(f"unsupported framebuffer depth: {bits_per_pixel} bpp")
+        self.size = stride * height
+
+        self._file = open(path, "r+b")
+        if os.path.isfile(path) and os.fstat(self._file.fileno()).st_size < self.size:
+            self._file.truncate(self.size)  # regular file standing in for the device
+        self._mmap = mmap.mmap(self._file.fileno(), self.size)
+        # the mapped screen, one row per stride (padding columns are never touched)
+        self.screen = np.ndarray(
+            (height, stride // dtype.itemsize), dtype=dtype, buffer=self._mmap
+        )[:, :width]
+
+        # preallocated work buffers, reused by every write
+        self.frame = np.zeros((height, width), dtype=dtype)
+        self.current = self.screen.copy()
+        self._channel = np.zeros((height, width), dtype=dtype)
+        self._changed = np.zeros((height, width), dtype=bool)
+
+    @property
+    def resolution(self):
+        return self.geometry.width, self.geometry.height
+
+    def write(self, img):
+        """
+        Show a PIL RGB image of the screen size; returns the number of bytes written.
+        """
+        if img.size != self.resolution:
+            raise ValueError(f"image is {img.size}, framebuffer is {self.resolution}")
+        self._convert(np.asarray(img.convert("RGB")))
+
+        np.not_equal(self.frame, self.current, out=self._changed)
+        rows = np.flatnonzero(self._changed.any(axis=1))
+        written = 0
+        for start, stop in _row_spans(rows):
+            # dirty rectangle: the changed rows, narrowed to their changed columns
+            columns = np.flatnonzero(self._changed[start:stop].any(axis=0))
+            left, right = columns[0], columns[-1] + 1
+            self.screen[start:stop, left:right] = self.frame[start:stop, left:right]
+            self.current[start:stop, left:right] = self.frame[start:stop, left:right]
+            written += (stop - start) * (right - left) * self.frame.itemsize
+        return written
+
+    def _convert(self, rgb):
+        """RGB888 pixels into self.frame, in the framebuffer format, without temporaries."""
+        frame, channel = self.frame, self._channel
+        if self.geometry.bits_per_pixel == 16:
+            np.right_shift(rgb[:, :, 0], 3, out=frame, casting="unsafe")
+            np.left_shift(frame, 11, out=frame)
+            np.right_shift(rgb[:, :, 1], 2, out=channel, casting="unsafe")
+            np.left_shift(channel, 5, out=channel)
+            np.bitwise_or(frame, channel, out=frame)
+            np.right_shift(rgb[:, :, 2], 3, out=channel, casting="unsafe")
+            np.bitwise_or(frame, channel, out=frame)
+        else:
+            np.copyto(frame, rgb[:, :, 0], casting="unsafe")
+            np.left_shift(frame, 16, out=frame)
+            np.copyto(channel, rgb[:, :, 1], casting="unsafe")
+            np.left_shift(channel, 8, out=channel)
+            np.bitwise_or(frame, channel, out=frame)
+            np.copyto(channel, rgb[:, :, 2], casting="unsafe")
+            np.bitwise_or(frame, channel, out=frame)
+
+    def close(self):
+        self.screen = None
+        self._mmap.close()
+        self._file.close()
+
+
+def _row_spans(rows):
+    """Group sorted row indexes into (start, stop) runs of consecutive rows."""
+    start = prev = None
+    for row in rows:
+        if start is None:
+            start = prev = row
+        elif row == prev + 1:
+            prev = row
+        else:
+            yield start, prev + 1
+            start = prev = row
+    if start is not None:
+        yield start, prev + 1
@@ -0,0 +1,209 @@
+"""
+Long-lived renderer for the monitor client.
+
+A separate process owns pygame: it opens the fullscreen display once, keeps the
+last images scaled to the screen and the last text overlays rendered, and draws
+the requests it takes from a queue into a double-buffered display. Several
+requests queued at once are drawn as one frame. Showing an already loaded image
+or changing the overlay text (timers, countdowns) costs a single frame.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+MAX_CACHED_SURFACES = 8  # images kept scaled to the screen
+MAX_CACHED_TEXTS = 64    # rendered text overlays
+SHOW_TIMEOUT = 10        # seconds a waiting request gives the renderer to draw
+EVENT_PUMP_INTERVAL = 0.5
+FONT_NAME = "DejaVuSans"
+TEXT_COLOR = (255, 255, 255)
+TEXT_BACKGROUND = (0, 0, 0)
+# The renderer is started lazily from a command worker while other threads hold
+# locks; a forked child could inherit one of them held and hang, so it is spawned
+_mp = multiprocessing.get_context("spawn")
+
+
+class LRUCache():
+    """Bounded mapping that drops the least recently used entry when full."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key, build):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        value = build()
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+        return value
+
+
+class Renderer():
+    """
+    Handle on the renderer process. Requests are put on a queue; show() waits
+    until the frame is on screen so callers can ack their command afterwards.
+    """
+
+    def __init__(self):
+        self.requests = _mp.Queue()
+        self.replies = _mp.Queue()
+        self.process = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def start(self):
+        """Start (or restart, if it died) the renderer process."""
+        if self.process is None or not self.process.is_alive():
+            self.process = _mp.Process(
+                target=render_loop, args=(self.requests, self.replies), daemon=True
+            )
+            self.process.start()
+
+    def show(self, img_path, text=None, font_size=None, wait=True):
+        """Show an image (scaled to fullscreen) with an optional centered text overlay."""
+        self._request({
+            "op": "show", "image": os.path.abspath(img_path), "text": text, "font_size": font_size
+        }, wait)
+
+    def set_text(self, text, font_size=None, wait=False):
+        """Replace the overlay text over the current image."""
+        self._request({"op": "text", "text": text, "font_size": font_size}, wait)
+
+    def preload(self, img_path):
+        """Load and scale an image ahead of the show() that will need it."""
+        self._request({"op": "preload", "image": os.path.abspath(img_path)}, wait=False)
+
+    def close(self):
+        if self.process is not None and self.process.is_alive():
+            self.requests.put({"op": "stop"})
+            self.process.join(SHOW_TIMEOUT)
+        self.process = None
+
+    def _request(self, request, wait):
+        self.start()
+        with self._lock:
+            self._next_id += 1
+            request["id"] = self._next_id
+            request["reply"] = wait
+            self.requests.put(request)
+            if not wait:
+                return
+            while True:
+                try:
+                    reply_id, error = self.replies.get(timeout=SHOW_TIMEOUT)
+                except queue.Empty:
+                    raise TimeoutError("renderer did not draw the frame in time")
+                if reply_id == request["id"]:
+                    break
+        if error:
+            raise RuntimeError(error)
+
+
+class RenderState():
+    """What is on screen, plus the surface caches (renderer process side)."""
+
+    def __init__(self, pygame, screen):
+        self.pygame = pygame
+        self.screen = screen
+        self.surfaces = LRUCache(MAX_CACHED_SURFACES)
+        self.texts = LRUCache(MAX_CACHED_TEXTS)
+        self.fonts = {}
+        self.image = None
+        self.text = None
+        self.font_size = 100
+
+    def handle(self, request):
+        """Apply a request; returns True if the screen has to be redrawn."""
+        op = request.get("op")
+        if op == "preload":
+            self.surface(request["image"])
+            return False
+        if op == "show":
+            self.image = self.surface(request["image"])
+        elif op != "text":
+            raise ValueError(f"unknown renderer request {op}")
+        self.text = request.get("text")
+        self.font_size = request.get("font_size") or self.font_size
+        return True
+
+    def surface(self, path):
+        stat = os.stat(path)
+        # keyed by file version, so a replaced file is loaded again
+        return self.surfaces.get((path, stat.st_mtime_ns, stat.st_size), lambda: self.load(path))
+
+    def load(self, path):
+        img = self.pygame.image.load(path)
+        if img.get_size() != self.screen.get_size():  # pre-rendered images already fit
+            img = self.pygame.transform.scale(img, self.screen.get_size())
+        return img.convert()
+
+    def text_surface(self, text, font_size):
+        def render():
+            font = self.fonts.get(font_size)
+            if font is None:
+                font = self.fonts[font_size] = self.pygame.font.SysFont(FONT_NAME, font_size)
+            return font.render(text, True, TEXT_COLOR, TEXT_BACKGROUND)
+        return self.texts.get((text, font_size), render)
+
+    def draw(self):
+        """Compose the frame in the back buffer and flip it on screen."""
+        self.screen.fill((0, 0, 0))
+        if self.image is not None:
+            self.screen.blit(self.image, (0, 0))
+        if self.text:
+            text_surface = self.text_surface(self.text, self.font_size)
+            text_rect = text_surface.get_rect(
+                center=(self.screen.get_width() // 2, self.screen.get_height() // 2)
+            )
+            self.screen.blit(text_surface, text_rect)
+        self.pygame.display.flip()
+
+
+def render_loop(requests, replies):
+    """Main loop of the renderer process."""
+    import pygame
+
+    pygame.init()
+    screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN | pygame.DOUBLEBUF)
+    pygame.mouse.set_visible(False)
+    state = RenderState(pygame, screen)
+
+    while True:
+        try:
+            batch = [requests.get(timeout=EVENT_PUMP_INTERVAL)]
+        except queue.Empty:
+            pygame.event.pump()
+            continue
+        # draw everything already queued as a single frame
+        while True:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+
+        redraw = False
+        done = []
+        for request in batch:
+            if request.get("op") == "stop":
+                pygame.quit()
+                return
+            error = None
+            try:
+                redraw = state.handle(request) or redraw
+            except Exception as e:
+                error = str(e)
+            if request.get("reply"):
+                done.append((request["id"], error))
+        if redraw:
+            try:
+                state.draw()
+            except Exception as e:
+                done = [(request_id, error or str(e)) for request_id, error in done]
+        pygame.event.pump()
+        for reply in done:
+            replies.put(reply)
@@ -1,31 +1,20 @@
 from PIL import Image, ImageDraw, ImageFont
 import subprocess
 import os
-import numpy as np
-import pygame
+from renderer import Renderer
+from framebuffer import Framebuffer, screen_geometry
 import time
 import itertools
 
+_renderer = None
+_framebuffer = None
+_fullscreen = None  # (file version, image resized to the screen)
+_fonts = {}
+
 def get_screen_resolution():
-    # Use fbset to get resolution from framebuffer
-    try:
-        output = os.popen("fbset -s | grep geometry").read()
-        _, w, h, *_ = output.split()
-        return int(w), int(h)
-    except:
-        #  if fbset is missing
-        print("fbset is missing")
-        return 800, 480
-
-
-def rgb888_to_rgb565(img):
-    """Convert PIL RGB image to RGB565 byte array"""
-    arr = np.array(img, dtype=np.uint8)
-    r = (arr[:,:,0] >> 3).astype(np.uint16)
-    g = (arr[:,:,1] >> 2).astype(np.uint16)
-    b = (arr[:,:,2] >> 3).astype(np.uint16)
-    rgb565 = (r << 11) | (g << 5) | b
-    return rgb565.astype("<u2").tobytes()  # little-endian 16-bit
+    # Read once from the framebuffer (sysfs, or fbset if missing), then cached
+    geometry = screen_geometry()
+    return geometry.width, geometry.height
 
 
 def main(img_path, text_to_insert):
@@ -51,14 +40,13 @@ def main(img_path, text_to_insert):
 
 
 def show(img_path,text_to_insert):
-    screen_w, screen_h = get_screen_resolution()
-    img = Image.open(img_path).convert("RGB")
-    img = img.resize((screen_w, screen_h))  # set to your screen resolution
+    img = load_fullscreen(img_path).copy()  # keep the cached one without text
 
     draw = ImageDraw.Draw(img) # draw the image to variable
-    font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 160)
+    font = get_font(160)
     # Get text size
-    text_w, text_h = draw.textsize(text_to_insert, font=font)
+    left, top, right, bottom = draw.textbbox((0, 0), text_to_insert, font=font)
+    text_w, text_h = right - left, bottom - top
     #text position
     x, y = 250, 700
     padding = 20  # padding around text
@@ -67,40 +55,52 @@ def show(img_path,text_to_insert):
         fill=(0, 0, 0) # black
     )
     draw.text((250, 700), text_to_insert, (250, 20, 100), font=font)
-    # Convert to correct pixel format for framebuffer
-    # (most Raspberry Pi screens use 16-bit RGB565)
-    fb_bytes = rgb888_to_rgb565(img)
-    with open("/dev/fb0", "wb") as f:
-        f.write(fb_bytes)
+    # Converted to the framebuffer format (most Raspberry Pi screens use 16-bit
+    # RGB565); only the rows that changed since the last frame are written
+    get_framebuffer().write(img)
 
-def cast(img_path,text_to_insert,font_size):
 
-    pygame.init()
+def get_font(size):
+    if size not in _fonts:
+        _fonts[size] = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", size)
+    return _fonts[size]
 
-    # Open fullscreen window
-    screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-    pygame.mouse.set_visible(False)
 
-    # Font for overlay text
-    font = pygame.font.SysFont("DejaVuSans", font_size)
-    def show_image(path, overlay_text):
-        # Load image
-        img = pygame.image.load(path)
-        img = pygame.transform.scale(img, screen.get_size())  # fit screen
+def get_framebuffer():
+    global _framebuffer
+    if _framebuffer is None:
+        _framebuffer = Framebuffer()
+    return _framebuffer
 
-        # Draw image
-        screen.blit(img, (0, 0))
 
-        # Draw text overlay (white text, black background)
-        if overlay_text:
-            text_surface = font.render(overlay_text, True, (255, 255, 255), (0, 0, 0))
-            text_rect = text_surface.get_rect(center=(screen.get_width() // 2, screen.get_height() // 2))
-            screen.blit(text_surface, text_rect)
+def load_fullscreen(img_path):
+    """The image resized to the screen, cached while the same file is shown"""
+    global _fullscreen
+    stat = os.stat(img_path)
+    key = (os.path.abspath(img_path), stat.st_mtime_ns, stat.st_size)
+    if _fullscreen is None or _fullscreen[0] != key:
+        img = Image.open(img_path).convert("RGB")
+        if img.size != get_screen_resolution():
+            img = img.resize(get_screen_resolution())
+        _fullscreen = (key, img)
+    return _fullscreen[1]
 
-        # Update display
-        pygame.display.update()
-    
-    show_image(img_path,text_to_insert)
+def cast(img_path,text_to_insert,font_size):
+    """Show the image with a text overlay through the persistent renderer process"""
+    get_renderer().show(img_path, text_to_insert, font_size)
+
+
+def preload(img_path):
+    """Load and scale an image in the renderer before it has to be shown"""
+    get_renderer().preload(img_path)
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer()
+        _renderer.start()
+    return _renderer
 
 
 
@@ -110,5 +110,6 @@ if __name__ == "__main__":
 # i provided 3 functions cast , show , and main 
 # main is not fast and relay on the fbi
 #show is fast and lightwight but does not support many features
-# cast is good because ther is many possibilities like animations and text rendring
+# cast is good because ther is many possibilities like animations and text rendring,
+# and is fast: it draws through a renderer process that keeps the display open
 # choose one 
\ No newline at end of file
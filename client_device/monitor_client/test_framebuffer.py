@@ -0,0 +1,89 @@
+"""
+Tests of Framebuffer against a temporary file standing in for /dev/fb0; run
+with `python -m pytest` from this directory.
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from framebuffer import Framebuffer, Geometry
+
+WIDTH, HEIGHT = 8, 6
+
+
+def open_framebuffer(tmp_path, bits_per_pixel, padding=0):
+    path = tmp_path / "fb0"
+    path.write_bytes(b"")
+    stride = WIDTH * bits_per_pixel // 8 + padding
+    return path, Framebuffer(str(path), Geometry(WIDTH, HEIGHT, bits_per_pixel, stride))
+
+
+def pixels(path, dtype, stride):
+    """The file as rows of pixels, padding included."""
+    data = np.frombuffer(path.read_bytes(), dtype=dtype)
+    return data.reshape(HEIGHT, stride // data.itemsize)
+
+
+def test_file_is_sized_to_the_geometry(tmp_path):
+    path, fb = open_framebuffer(tmp_path, 16, padding=4)
+    fb.close()
+    assert path.stat().st_size == (WIDTH * 2 + 4) * HEIGHT
+
+
+def test_rgb565_pixels(tmp_path):
+    path, fb = open_framebuffer(tmp_path, 16, padding=4)
+    img = Image.new("RGB", (WIDTH, HEIGHT), (255, 0, 0))
+    img.putpixel((1, 2), (0, 255, 0))
+    img.putpixel((2, 2), (0, 0, 255))
+    img.putpixel((3, 2), (0x84, 0x82, 0x08))
+    assert fb.write(img) == WIDTH * HEIGHT * 2
+    fb.close()
+
+    screen = pixels(path, "<u2", WIDTH * 2 + 4)
+    assert screen[0, 0] == 0xF800
+    assert screen[2, 1] == 0x07E0
+    assert screen[2, 2] == 0x001F
+    assert screen[2, 3] == (0x84 >> 3) << 11 | (0x82 >> 2) << 5 | 0x08 >> 3
+    assert not screen[:, WIDTH:].any()  # the stride padding is never written
+
+
+def test_xrgb8888_pixels(tmp_path):
+    path, fb = open_framebuffer(tmp_path, 32)
+    img = Image.new("RGB", (WIDTH, HEIGHT), (0x12, 0x34, 0x56))
+    fb.write(img)
+    fb.close()
+
+    screen = pixels(path, "<u4", WIDTH * 4)
+    assert (screen == 0x00123456).all()
+    assert path.read_bytes()[:4] == bytes([0x56, 0x34, 0x12, 0x00])
+
+
+def test_only_the_changed_rectangle_is_written(tmp_path):
+    path, fb = open_framebuffer(tmp_path, 16)
+    img = Image.new("RGB", (WIDTH, HEIGHT), (255, 255, 255))
+    fb.write(img)
+    assert fb.write(img) == 0
+
+    img.putpixel((2, 1), (0, 0, 0))
+    img.putpixel((4, 3), (0, 0, 0))
+    # rows 1 and 3 are separate rectangles, columns 2 and 4 respectively
+    assert fb.write(img) == 2 * 2
+    fb.close()
+
+    screen = pixels(path, "<u2", WIDTH * 2)
+    assert screen[1, 2] == 0 and screen[3, 4] == 0
+    assert (screen == 0xFFFF).sum() == WIDTH * HEIGHT - 2
+
+
+def test_image_of_another_size_is_rejected(tmp_path):
+    _, fb = open_framebuffer(tmp_path, 16)
+    with pytest.raises(ValueError, match="framebuffer is"):
+        fb.write(Image.new("RGB", (WIDTH + 1, HEIGHT)))
+    fb.close()
+
+
+def test_unsupported_depth_is_rejected(tmp_path):
+    path = tmp_path / "fb0"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError, match="24 bpp"):
+        Framebuffer(str(path), Geometry(WIDTH, HEIGHT, 24, WIDTH * 3))
@@ -0,0 +1,107 @@
+import json
+
+import command_trace
+
+# Pub/sub channel the TCP gateway listens on to wake the connection of a device
+COMMANDS_CHANNEL = "device_commands"
+# Consumer group the gateways read the command streams in. An entry stays in the
+# group's pending list until the device acks it, then it is deleted, so the
+# length of a stream is the number of commands not yet done
+COMMANDS_GROUP = "gateways"
+
+
+def owner_key(device_id):
+    """Lease naming the gateway that serves a device (see tcp_server/server.py)."""
+    return f'device_owner:{device_id}'
+
+
+def inbox_channel(gateway_id):
+    """Pub/sub channel waking the devices one gateway owns."""
+    return f'{COMMANDS_CHANNEL}:{gateway_id}'
+
+
+def commands_key(device_id):
+    """Redis stream holding the pending commands of a device, one 'command' field per entry."""
+    return f'{device_id}:commands'
+
+
+def build_start_command(node_id, scenario_name, config):
+    """
+    Build the payload of a 'start' command, with a new trace id.
+    Config values sent as the string "null" by the editor are turned into None.
+    """
+    simple_config = {}
+    for key, value in (config or {}).items():
+        if value == "null":
+            simple_config[key] = None
+        else:
+            simple_config[key] = value
+
+    return {
+        'command': 'start',
+        'config': simple_config,
+        'node_id': node_id,
+        'scenario_name': scenario_name,
+        'trace_id': command_trace.new_trace_id()
+    }
+
+
+def build_command(command, config=None, node_id=None, scenario_name=None):
+    """
+    Build a queued command: a bare string like "reset" when there is nothing to
+    send with it, the full JSON payload otherwise.
+    """
+    if config is None and node_id is None and scenario_name is None:
+        return command
+    command_data = build_start_command(node_id, scenario_name, config)
+    command_data['command'] = command
+    return command_data
+
+
+def enqueue_command(redis_client, device_id, command):
+    """
+    Queue a command for a device.
+    `command` is either a dict (sent as JSON) or a bare command string like "reset".
+    """
+    enqueue_commands(redis_client, [(device_id, command)])
+
+
+def enqueue_commands(redis_client, commands):
+    """
+    Queue a list of (device_id, command) pairs in one MULTI/EXEC round trip:
+    either every device gets its command or none does.
+    The gateway reads the streams in order (FIFO), and each device id is
+    published to wake its connection: on the inbox of the gateway owning the
+    device, or on COMMANDS_CHANNEL for devices no gateway owns.
+    Commands for a node start their trace here.
+    """
+    device_ids = list(dict.fromkeys(device_id for device_id, _ in commands))
+    owners = dict(zip(device_ids, redis_client.mget([owner_key(d) for d in device_ids]))) if device_ids else {}
+    pipe = redis_client.pipeline(transaction=True)
+    for device_id, command in commands:
+        if isinstance(command, dict):
+            command_trace.add_event(
+                pipe, command, 'enqueued', command=command.get('command'), device_id=device_id
+            )
+            command = json.dumps(command)
+        pipe.xadd(commands_key(device_id), {'command': command})
+        owner = owners[device_id]
+        pipe.publish(inbox_channel(owner) if owner else COMMANDS_CHANNEL, device_id)
+    pipe.execute()
+
+
+def migrate_legacy_queues(redis_client):
+    """
+    Move the commands of queues left as plain lists by older versions into
+    their streams. Safe to run on every start; returns the number moved.
+    """
+    migrated = 0
+    for key in redis_client.scan_iter(match='*:commands', _type='list'):
+        commands = redis_client.lrange(key, 0, -1)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(key)
+        for command in commands:
+            pipe.xadd(key, {'command': command})
+        pipe.execute()
+        migrated += len(commands)
+    return migrated
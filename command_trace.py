@@ -0,0 +1,100 @@
+import time
+import uuid
+
+# Every command queued for a node carries a trace id, and each hop it passes
+# appends an event to the node's `trace:<node_id>` stream:
+#   enqueued  the backend queued it              (command_queue)
+#   dequeued  the gateway popped it              (tcp_server)
+#   sent      the gateway wrote it to the device, assets first; again on a resend
+#   acked     the device acked it, with the time it waited for a worker
+#             (device_wait_ms) and the time execute_command took (device_run_ms)
+#   failed    the device went away before acking
+# Timestamps are the writer's wall clock; the backend and the gateway share a host.
+TRACE_MAXLEN = 200        # events kept per node, about 40 commands
+TRACE_TTL = 24 * 3600     # seconds a node's trace outlives its last event
+
+
+def trace_key(node_id):
+    return f"trace:{node_id}"
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def add_event(pipe, command_data, stage, **fields):
+    """
+    Queue the XADD of one stage of a command on `pipe`. Commands without a
+    node_id or trace_id are not traced.
+    """
+    node_id = command_data.get('node_id')
+    trace_id = command_data.get('trace_id')
+    if not node_id or not trace_id:
+        return
+    event = {key: value for key, value in fields.items() if value is not None}
+    event.update(trace_id=trace_id, stage=stage, ts=time.time())
+    pipe.xadd(trace_key(node_id), event, maxlen=TRACE_MAXLEN, approximate=True)
+    pipe.expire(trace_key(node_id), TRACE_TTL)
+
+
+def get_traces(redis_client, node_id):
+    """
+    The commands traced for a node, most recent first, each with its events and
+    the latency of every hop in milliseconds:
+      queue_ms      enqueued -> dequeued, waiting in the device's Redis queue
+      dispatch_ms   dequeued -> sent, pushing assets and writing the command
+      device_ms     sent -> acked, of which device_wait_ms and device_run_ms were
+                    spent on the device and transport_ms on the network
+      total_ms      enqueued -> acked (or failed)
+    """
+    traces = {}
+    for _, event in redis_client.xrange(trace_key(node_id)):
+        trace = traces.setdefault(event.get('trace_id'), {
+            'trace_id': event.get('trace_id'),
+            'node_id': node_id,
+            'events': []
+        })
+        event = dict(event)
+        event.pop('trace_id', None)
+        for field in event:
+            if field == 'ts' or field.endswith('_ms'):
+                event[field] = float(event[field])
+        trace['events'].append(event)
+    for trace in traces.values():
+        trace['breakdown'] = breakdown(trace['events'])
+        ends = [e for e in trace['events'] if e['stage'] in ('acked', 'failed')]
+        trace['status'] = ends[-1].get('status', ends[-1]['stage']) if ends else 'in progress'
+        trace['command'] = trace['events'][0].get('command')
+    return sorted(traces.values(), key=lambda trace: trace['events'][0]['ts'], reverse=True)
+
+
+def breakdown(events):
+    """Per-hop latencies of one command's events; hops it did not reach are left out."""
+    first = {}
+    last = {}
+    for event in events:
+        first.setdefault(event['stage'], event)
+        last[event['stage']] = event
+
+    def elapsed(start, end):
+        return round((end['ts'] - start['ts']) * 1000, 2)
+
+    latencies = {}
+    end = last.get('acked') or last.get('failed')
+    if 'enqueued' in first and 'dequeued' in first:
+        latencies['queue_ms'] = elapsed(first['enqueued'], first['dequeued'])
+    if 'dequeued' in first and 'sent' in first:
+        latencies['dispatch_ms'] = elapsed(first['dequeued'], first['sent'])
+    if 'acked' in last and 'sent' in last:
+        # the device ran the command it got last, after a reconnect possibly
+        ack = last['acked']
+        latencies['device_ms'] = elapsed(last['sent'], ack)
+        if 'device_wait_ms' in ack and 'device_run_ms' in ack:
+            latencies['device_wait_ms'] = ack['device_wait_ms']
+            latencies['device_run_ms'] = ack['device_run_ms']
+            latencies['transport_ms'] = round(
+                latencies['device_ms'] - latencies['device_wait_ms'] - latencies['device_run_ms'], 2
+            )
+    if 'enqueued' in first and end:
+        latencies['total_ms'] = elapsed(first['enqueued'], end)
+    return latencies
@@ -0,0 +1,83 @@
+import json
+
+# Registry written by the TCP gateway: one `device:<device_id>` key per connected
+# device (expiring unless the gateway keeps refreshing it) plus a set indexing them
+DEVICES_INDEX = "devices"
+# Pub/sub channel announcing every registry change
+DEVICE_EVENTS_CHANNEL = "device_events"
+
+
+def device_key(device_id):
+    return f"device:{device_id}"
+
+
+def health_key(device_id):
+    """Hash the gateway keeps next to the entry: link state, heartbeat RTT stats."""
+    return f"device_health:{device_id}"
+
+
+def register_device(redis_client, device_id, device_info, ttl=None):
+    """Add or replace one registry entry; without a ttl the entry never expires."""
+    pipe = redis_client.pipeline()
+    pipe.set(device_key(device_id), json.dumps(device_info), ex=ttl)
+    pipe.sadd(DEVICES_INDEX, device_id)
+    pipe.publish(DEVICE_EVENTS_CHANNEL, json.dumps({"event": "updated", "device_id": device_id}))
+    pipe.execute()
+
+
+def get_devices(redis_client):
+    """All registered devices as {device_id: device_info}."""
+    device_ids = sorted(redis_client.smembers(DEVICES_INDEX))
+    if not device_ids:
+        return {}
+    values = redis_client.mget([device_key(device_id) for device_id in device_ids])
+    devices = {}
+    expired = []
+    for device_id, value in zip(device_ids, values):
+        if value is None:
+            expired.append(device_id)
+        else:
+            devices[device_id] = json.loads(value)
+    _prune(redis_client, expired)
+    return devices
+
+
+def get_device_ids(redis_client):
+    """Ids of the registered devices, without reading their info."""
+    device_ids = sorted(redis_client.smembers(DEVICES_INDEX))
+    pipe = redis_client.pipeline()
+    for device_id in device_ids:
+        pipe.exists(device_key(device_id))
+    alive = pipe.execute() if device_ids else []
+    _prune(redis_client, [d for d, exists in zip(device_ids, alive) if not exists])
+    return [d for d, exists in zip(device_ids, alive) if exists]
+
+
+def get_health(redis_client, device_ids):
+    """
+    {device_id: health} for the given devices: state (online or reconnecting),
+    last_seen, missed heartbeats and RTT statistics in milliseconds.
+    Devices without health data are left out.
+    """
+    pipe = redis_client.pipeline()
+    for device_id in device_ids:
+        pipe.hgetall(health_key(device_id))
+    results = pipe.execute() if device_ids else []
+    health = {}
+    for device_id, fields in zip(device_ids, results):
+        if not fields:
+            continue
+        entry = {}
+        for field, value in fields.items():
+            try:
+                entry[field] = float(value) if field != 'state' else value
+            except ValueError:
+                entry[field] = value
+        health[device_id] = entry
+    return health
+
+
+def _prune(redis_client, expired):
+    """Drop index members whose entry expired (their gateway went away)."""
+    if expired:
+        redis_client.srem(DEVICES_INDEX, *expired)
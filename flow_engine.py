@@ -0,0 +1,530 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from command_queue import build_command, build_start_command, enqueue_command, enqueue_commands
+import scenario_catalog
+
+logger = logging.getLogger(__name__)
+
+DEVICE_TIMEOUT = 300        # seconds a device node may run before it is failed
+STATUS_SWEEP_INTERVAL = 1  # seconds between two fallback status sweeps
+FLOW_EVENTS_CHANNEL = "flow_events"
+RUN_TTL = 24 * 3600         # how long finished runs stay readable in Redis
+PREFETCH_DEPTH = 2          # steps ahead of the running nodes whose assets devices prefetch
+UPLOADS_PREFIX = "/static/uploads/"
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def run_key(run_id):
+    return f"flow_run:{run_id}"
+
+
+def publish_node_event(redis_client, event):
+    """Announce a node status change to /events subscribers."""
+    event.setdefault('timestamp', time.time())
+    redis_client.publish(FLOW_EVENTS_CHANNEL, json.dumps(event))
+
+
+def node_kind(node):
+    """Same dispatch key the editor uses: `data.deviceType` first, then the node type."""
+    return (node.get('data') or {}).get('deviceType') or node.get('type')
+
+
+def flatten_config(config):
+    """Turn the editor's {field: {value: ...}} config into {field: value}."""
+    flat = {}
+    for key, item in (config or {}).items():
+        if isinstance(item, dict):
+            flat[key] = item.get('value', "null")
+        else:
+            flat[key] = item
+    return flat
+
+
+def node_assets(node):
+    """Uploaded files a device node's config refers to, as {field: upload URL}."""
+    config = flatten_config((node.get('data') or {}).get('config'))
+    return {
+        key: value for key, value in config.items()
+        if isinstance(value, str) and value.startswith(UPLOADS_PREFIX)
+    }
+
+
+def prefetch_assets(redis_client, graph, node_ids, scenario_name, depth=PREFETCH_DEPTH, seen=None):
+    """
+    Queue a 'prefetch' command for every device node up to `depth` steps after
+    `node_ids` that uses uploaded files, so the device has them cached before its
+    start command arrives. Nodes in `seen` are skipped and the visited ones added.
+    Returns the number of commands queued.
+    """
+    commands = []
+    for node_id in graph.lookahead(node_ids, depth):
+        if seen is not None:
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+        node = graph.nodes[node_id]
+        if node_kind(node) != 'device':
+            continue
+        device_id = (node.get('data') or {}).get('originalDeviceId')
+        assets = node_assets(node)
+        if device_id and assets:
+            commands.append(
+                (device_id, build_command('prefetch', assets, scenario_name=scenario_name))
+            )
+    if commands:
+        enqueue_commands(redis_client, commands)
+    return len(commands)
+
+
+class FlowGraph():
+    """
+    Scenario nodes/edges compiled into a DAG reachable from the start ('input') node.
+    """
+
+    def __init__(self, flow):
+        nodes = {node['id']: node for node in flow.get('nodes', [])}
+        successors = {node_id: [] for node_id in nodes}
+        predecessors = {node_id: [] for node_id in nodes}
+        for edge in flow.get('edges', []):
+            source, target = edge.get('source'), edge.get('target')
+            if source in nodes and target in nodes and target not in successors[source]:
+                successors[source].append(target)
+                predecessors[target].append(source)
+
+        start = [node_id for node_id, node in nodes.items() if node.get('type') == 'input']
+        if not start:
+            raise ValueError("No start node found")
+
+        # only nodes reachable from the start node take part in a run
+        reachable = set()
+        stack = list(start)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in reachable:
+                reachable.add(node_id)
+                stack.extend(successors[node_id])
+
+        self.nodes = {node_id: nodes[node_id] for node_id in nodes if node_id in reachable}
+        self.successors = {node_id: successors[node_id] for node_id in self.nodes}
+        self.predecessors = {
+            node_id: [p for p in predecessors[node_id] if p in reachable] for node_id in self.nodes
+        }
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        indegree = {node_id: len(preds) for node_id, preds in self.predecessors.items()}
+        ready = [node_id for node_id, degree in indegree.items() if degree == 0]
+        order = []
+        while ready:
+            node_id = ready.pop()
+            order.append(node_id)
+            for succ in self.successors[node_id]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0:
+                    ready.append(succ)
+        if len(order) != len(self.nodes):
+            raise ValueError("Scenario graph contains a cycle")
+        return order
+
+    def lookahead(self, node_ids, depth):
+        """Nodes reachable in 1 to `depth` steps from `node_ids`, nearest first."""
+        seen = set(node_ids)
+        frontier = [node_id for node_id in node_ids if node_id in self.nodes]
+        ahead = []
+        for _ in range(depth):
+            next_frontier = []
+            for node_id in frontier:
+                for succ in self.successors[node_id]:
+                    if succ not in seen:
+                        seen.add(succ)
+                        next_frontier.append(succ)
+            ahead.extend(next_frontier)
+            frontier = next_frontier
+        return ahead
+
+    def condition_sources(self, node_id):
+        """
+        Sources a condition node monitors: the checked `source_*` entries of its config,
+        or every connected non-start source when none is checked.
+        """
+        connected = [
+            p for p in self.predecessors[node_id] if self.nodes[p].get('type') != 'input'
+        ]
+        config = (self.nodes[node_id].get('data') or {}).get('config') or {}
+        checked = [
+            item.get('sourceNodeId') for key, item in config.items()
+            if key.startswith('source_') and isinstance(item, dict)
+            and (item.get('value') in (True, 'true') or item.get('checked') is True)
+        ]
+        checked = [source for source in checked if source in connected]
+        return checked or connected
+
+    def condition_logic(self, node_id):
+        config = (self.nodes[node_id].get('data') or {}).get('config') or {}
+        logic = config.get('logicType') or {}
+        logic = logic.get('value') if isinstance(logic, dict) else logic
+        logic = str(logic or 'AND').upper()
+        return logic if logic in ('AND', 'OR') else 'AND'
+
+
+class StatusWatcher():
+    """
+    Waits for `flow_execution:<node_id>` to reach a final state.
+    Transitions arrive as FLOW_EVENTS_CHANNEL messages published by the TCP gateway;
+    a slow MGET sweep over the watched nodes covers messages missed on reconnects.
+    """
+
+    FINAL_STATUSES = (COMPLETED, FAILED)
+
+    def __init__(self, redis_client, sweep_interval=STATUS_SWEEP_INTERVAL):
+        self.redis_client = redis_client
+        self.sweep_interval = sweep_interval
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, node_id):
+        """
+        Register interest in a node before its command is queued, so a fast
+        device cannot finish before anyone is listening.
+        """
+        waiter = {'node_id': node_id, 'event': threading.Event(), 'status': None}
+        with self._lock:
+            self._waiters.setdefault(node_id, []).append(waiter)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return waiter
+
+    def wait(self, waiter, timeout, cancel=None):
+        """
+        Block until the watched node finishes; returns its final status, or None on
+        timeout or once the optional `cancel` event is set.
+        """
+        deadline = time.time() + timeout
+        try:
+            while not waiter['event'].wait(min(0.5, max(deadline - time.time(), 0))):
+                if time.time() >= deadline or (cancel is not None and cancel.is_set()):
+                    break
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(waiter['node_id'], [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(waiter['node_id'], None)
+        return waiter['status']
+
+    def _run(self):
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(FLOW_EVENTS_CHANNEL)
+        last_sweep = time.time()
+        while True:
+            try:
+                message = pubsub.get_message(timeout=self.sweep_interval)
+                if message:
+                    event = json.loads(message['data'])
+                    # the engine's own node events carry a run_id, device events do not
+                    if not event.get('run_id') and event.get('status') in self.FINAL_STATUSES:
+                        self._notify(event.get('node_id'), event['status'])
+                if time.time() - last_sweep >= self.sweep_interval:
+                    self._sweep()
+                    last_sweep = time.time()
+            except Exception as e:
+                logger.error(f"Error watching node statuses: {e}")
+                time.sleep(1)
+
+    def _sweep(self):
+        with self._lock:
+            node_ids = list(self._waiters)
+        if not node_ids:
+            return
+        statuses = self.redis_client.mget([f"flow_execution:{n}" for n in node_ids])
+        for node_id, status in zip(node_ids, statuses):
+            if status in self.FINAL_STATUSES:
+                self._notify(node_id, status)
+
+    def _notify(self, node_id, status):
+        with self._lock:
+            waiters = self._waiters.pop(node_id, [])
+        for waiter in waiters:
+            waiter['status'] = status
+            waiter['event'].set()
+
+
+class FlowRun():
+    """
+    One execution of a scenario. Ready nodes are dispatched concurrently as soon as
+    their predecessors are resolved; the state is mirrored to `flow_run:<run_id>`.
+    """
+
+    def __init__(self, engine, scenario_name, graph):
+        self.engine = engine
+        self.redis_client = engine.redis_client
+        self.run_id = uuid.uuid4().hex
+        self.scenario_name = scenario_name
+        self.graph = graph
+        self.status = PENDING
+        self.started_at = None
+        self.finished_at = None
+        self.nodes = {
+            node_id: {
+                'status': PENDING,
+                'label': (node.get('data') or {}).get('label'),
+                'started_at': None,
+                'finished_at': None,
+                'error': None
+            }
+            for node_id, node in graph.nodes.items()
+        }
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._prefetched = set()
+
+    # ---- State ----
+    def to_dict(self):
+        with self._lock:
+            return {
+                'run_id': self.run_id,
+                'scenario': self.scenario_name,
+                'status': self.status,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'nodes': {node_id: dict(state) for node_id, state in self.nodes.items()}
+            }
+
+    def _save(self):
+        try:
+            self.redis_client.set(run_key(self.run_id), json.dumps(self.to_dict()), ex=RUN_TTL)
+        except Exception as e:
+            logger.error(f"Error saving run {self.run_id}: {e}")
+
+    def _set_node(self, node_id, status, error=None):
+        with self._lock:
+            state = self.nodes[node_id]
+            state['status'] = status
+            if status == RUNNING:
+                state['started_at'] = time.time()
+            elif status != PENDING:
+                state['finished_at'] = time.time()
+            if error:
+                state['error'] = error
+        self._save()
+        try:
+            publish_node_event(self.redis_client, {
+                'node_id': node_id,
+                'status': status,
+                'scenario': self.scenario_name,
+                'run_id': self.run_id
+            })
+        except Exception as e:
+            logger.error(f"Error publishing status of node {node_id}: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    # ---- Scheduling ----
+    def _ready_nodes(self):
+        """
+        Pending nodes that can run now. Nodes whose inputs can no longer succeed are
+        skipped (or failed, for conditions) on the way, which may unlock more nodes.
+        """
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for node_id in self.graph.order:
+                if self.nodes[node_id]['status'] != PENDING:
+                    continue
+                decision = self._decide(node_id)
+                if decision == RUNNING:
+                    ready.append(node_id)
+                    self._set_node(node_id, RUNNING)
+                elif decision is not None:
+                    self._set_node(node_id, decision, error="Upstream node did not complete")
+                    changed = True
+        return ready
+
+    def _decide(self, node_id):
+        preds = [self.nodes[p]['status'] for p in self.graph.predecessors[node_id]]
+        if node_kind(self.graph.nodes[node_id]) == 'condition':
+            sources = [self.nodes[s]['status'] for s in self.graph.condition_sources(node_id)]
+            if not sources:
+                return RUNNING if all(s == COMPLETED for s in preds) else None
+            done = [s for s in sources if s == COMPLETED]
+            lost = [s for s in sources if s in (FAILED, SKIPPED)]
+            if self.graph.condition_logic(node_id) == 'AND':
+                if lost:
+                    return FAILED
+                return RUNNING if len(done) == len(sources) else None
+            if done:
+                return RUNNING
+            return FAILED if len(lost) == len(sources) else None
+
+        if any(s in (FAILED, SKIPPED) for s in preds):
+            return SKIPPED
+        if all(s == COMPLETED for s in preds):
+            return RUNNING
+        return None
+
+    def run(self):
+        with self._lock:
+            self.status = RUNNING
+            self.started_at = time.time()
+        self._save()
+        logger.info(f"Run {self.run_id} of scenario {self.scenario_name} started")
+
+        futures = {}
+        try:
+            while True:
+                if not self._stop.is_set():
+                    ready = self._ready_nodes()
+                    for node_id in ready:
+                        future = self.engine.executor.submit(self._execute, node_id)
+                        futures[future] = node_id
+                    if ready:
+                        self._prefetch(ready)
+                if not futures:
+                    break
+                done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_id = futures.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        self._set_node(node_id, COMPLETED)
+                    else:
+                        logger.error(f"Run {self.run_id}: node {node_id} failed: {error}")
+                        self._set_node(node_id, FAILED, error=str(error))
+        finally:
+            self._finish()
+
+    def _finish(self):
+        for node_id, state in self.nodes.items():
+            if state['status'] == PENDING:
+                self._set_node(node_id, SKIPPED)
+        outputs = [
+            node_id for node_id, node in self.graph.nodes.items() if node.get('type') == 'output'
+        ]
+        if self._stop.is_set():
+            status = 'stopped'
+        elif outputs:
+            reached = any(self.nodes[n]['status'] == COMPLETED for n in outputs)
+            status = COMPLETED if reached else FAILED
+        else:
+            ok = all(state['status'] == COMPLETED for state in self.nodes.values())
+            status = COMPLETED if ok else FAILED
+        with self._lock:
+            self.status = status
+            self.finished_at = time.time()
+        self._save()
+        logger.info(f"Run {self.run_id} of scenario {self.scenario_name} {status}")
+
+    def _prefetch(self, node_ids):
+        try:
+            prefetch_assets(
+                self.redis_client, self.graph, node_ids, self.scenario_name,
+                seen=self._prefetched
+            )
+        except Exception as e:
+            logger.error(f"Run {self.run_id}: error queueing prefetch commands: {e}")
+
+    # ---- Node execution ----
+    def _execute(self, node_id):
+        node = self.graph.nodes[node_id]
+        data = node.get('data') or {}
+        config = data.get('config') or {}
+        kind = node_kind(node)
+
+        if kind == 'device':
+            self._execute_device(node_id, data)
+        elif kind == 'delay':
+            delay = flatten_config(config).get('delaySeconds') or data.get('delaySeconds') or 3
+            self._sleep(float(delay))
+        elif kind == 'virtual':
+            speed = flatten_config(config).get('speed') or 3000
+            self._sleep(float(speed) / 1000)
+        # input, output and condition nodes have nothing to execute
+
+    def _sleep(self, seconds):
+        if self._stop.wait(seconds):
+            raise RuntimeError("Execution was stopped")
+
+    def _execute_device(self, node_id, data):
+        device_id = data.get('originalDeviceId')
+        if not device_id:
+            raise RuntimeError("Device node has no device")
+        config = flatten_config(data.get('config'))
+
+        self.redis_client.delete(f"flow_execution:{node_id}")
+        self.redis_client.set(f'{device_id}:status', 'in progress')
+        waiter = self.engine.watcher.watch(node_id)
+        enqueue_command(
+            self.redis_client, device_id,
+            build_start_command(node_id, self.scenario_name, config)
+        )
+        logger.info(f"Run {self.run_id}: started device {device_id} for node {node_id}")
+
+        status = self.engine.watcher.wait(waiter, DEVICE_TIMEOUT, cancel=self._stop)
+        if self._stop.is_set():
+            raise RuntimeError("Execution was stopped")
+        if status is None:
+            raise RuntimeError(f"Device {device_id} timeout after {DEVICE_TIMEOUT} seconds")
+        if status != COMPLETED:
+            raise RuntimeError(f"Device {device_id} {status}")
+
+
+class FlowEngine():
+    """
+    Runs scenarios stored under `scenario_<name>` on the backend.
+    """
+
+    def __init__(self, redis_client, max_workers=64):
+        self.redis_client = redis_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.watcher = StatusWatcher(redis_client)
+        self.runs = {}
+
+    def start(self, scenario_name):
+        """
+        Compile the scenario and start running it in the background.
+        Raises KeyError if the scenario does not exist, ValueError if it cannot run.
+        """
+        flow_data = scenario_catalog.load(self.redis_client, scenario_name)
+        if not flow_data:
+            raise KeyError(scenario_name)
+        run = FlowRun(self, scenario_name, FlowGraph(flow_data))
+        self.runs[run.run_id] = run
+        run._save()
+        threading.Thread(target=self._run, args=(run,), daemon=True).start()
+        return run
+
+    def _run(self, run):
+        try:
+            run.run()
+        finally:
+            self.runs.pop(run.run_id, None)
+
+    def get(self, run_id):
+        """Current state of a run, from memory or from Redis once it has finished."""
+        run = self.runs.get(run_id)
+        if run:
+            return run.to_dict()
+        data = self.redis_client.get(run_key(run_id))
+        return json.loads(data) if data else None
+
+    def stop(self, run_id):
+        run = self.runs.get(run_id)
+        if not run:
+            return False
+        run.stop()
+        return True
@@ -0,0 +1,82 @@
+import os
+import re
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+# Output of each pixel format a device can declare, and the file extension it is cached under
+PIXEL_FORMATS = {
+    'RGB': 'png',       # monitors driven through pygame
+    'L': 'png',         # 8-bit grayscale e-paper (GC16)
+    '1': 'png',         # 1-bit e-paper (A2)
+    'RGB565': 'rgb565'  # raw little-endian 16-bit framebuffer bytes
+}
+PROFILE_PATTERN = re.compile(r'^(\d{1,5})x(\d{1,5})-(RGB565|RGB|L|1)$')
+
+
+def profile_name(display):
+    """
+    Name of the display profile a device declares in its device_info, e.g.
+    {"width": 1872, "height": 1404, "format": "L"} -> "1872x1404-L". None if invalid.
+    """
+    if not isinstance(display, dict):
+        return None
+    name = f"{display.get('width')}x{display.get('height')}-{display.get('format')}"
+    return name if PROFILE_PATTERN.match(name) else None
+
+
+def parse_profile(name):
+    """(width, height, pixel format) of a profile name; raises ValueError if invalid."""
+    match = PROFILE_PATTERN.match(name or '')
+    if not match:
+        raise ValueError(f"Invalid display profile: {name}")
+    width, height, pixel_format = int(match.group(1)), int(match.group(2)), match.group(3)
+    if not width or not height:
+        raise ValueError(f"Invalid display profile: {name}")
+    return width, height, pixel_format
+
+
+def rendered_filename(filename, profile):
+    _, _, pixel_format = parse_profile(profile)
+    return f"{os.path.splitext(filename)[0]}.{PIXEL_FORMATS[pixel_format]}"
+
+
+def rgb888_to_rgb565(img):
+    """Convert PIL RGB image to RGB565 byte array"""
+    arr = np.asarray(img, dtype=np.uint8)
+    rgb565 = (arr[:, :, 0].astype(np.uint16) >> 3) << 11
+    rgb565 |= (arr[:, :, 1].astype(np.uint16) >> 2) << 5
+    rgb565 |= arr[:, :, 2].astype(np.uint16) >> 3
+    return rgb565.astype("<u2").tobytes()  # little-endian 16-bit
+
+
+def render(source_path, profile, render_folder):
+    """
+    Render an uploaded image for a display profile, ready to blit as-is, and cache
+    it under render_folder/<profile>/. Returns the rendered file name.
+    """
+    width, height, pixel_format = parse_profile(profile)
+    filename = rendered_filename(os.path.basename(source_path), profile)
+    profile_folder = os.path.join(render_folder, profile)
+    target = os.path.join(profile_folder, filename)
+    if os.path.exists(target):
+        return filename
+
+    os.makedirs(profile_folder, exist_ok=True)
+    with Image.open(source_path) as img:
+        # same fullscreen stretch the devices applied themselves
+        img = img.convert("RGB").resize((width, height))
+    if pixel_format == 'L':
+        img = img.convert("L")
+    elif pixel_format == '1':
+        img = img.convert("L").convert("1")
+
+    # write then rename, so a concurrent reader never sees half a file
+    with tempfile.NamedTemporaryFile(dir=profile_folder, delete=False) as tmp:
+        if pixel_format == 'RGB565':
+            tmp.write(rgb888_to_rgb565(img))
+        else:
+            img.save(tmp, format="PNG")
+    os.replace(tmp.name, target)
+    return filename
@@ -0,0 +1,103 @@
+"""
+Prometheus metrics of the backend, served at /metrics in the text exposition format.
+
+HTTP latency is measured per Flask route (the URL rule, not the raw path, so
+labels stay bounded), Redis latency per command, with a pipeline counted as one
+round trip, and the depth of every `<device_id>:commands` stream (commands
+queued or sent but not acked) is read when the metrics are scraped.
+"""
+import time
+
+import redis
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+
+from command_queue import commands_key
+import device_registry
+
+# Buckets in seconds, from a fast Redis round trip to a slow upload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to handle an HTTP request, by route',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REDIS_COMMAND_SECONDS = Histogram(
+    'redis_command_duration_seconds', 'Redis round trip time, by command (PIPELINE/MULTI for batches)',
+    ['command'], buckets=LATENCY_BUCKETS
+)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing every command and pipeline it sends."""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            command = 'MULTI' if self.transaction else 'PIPELINE'
+            REDIS_COMMAND_SECONDS.labels(command).observe(time.perf_counter() - start)
+
+
+class CommandQueueCollector():
+    """Length of the command queue of every registered device, read at scrape time."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            'device_command_queue_depth', 'Commands queued for a device and not acked yet',
+            labels=['device_id']
+        )
+        try:
+            device_ids = device_registry.get_device_ids(self.redis_client)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for device_id in device_ids:
+                pipe.xlen(commands_key(device_id))
+            lengths = pipe.execute() if device_ids else []
+        except redis.RedisError:
+            device_ids, lengths = [], []
+        for device_id, length in zip(device_ids, lengths):
+            depth.add_metric([device_id], length)
+        yield depth
+
+
+def init_app(app, redis_client):
+    """Time the requests of `app` and serve the metrics at /metrics."""
+    REGISTRY.register(CommandQueueCollector(redis_client))
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else '<unmatched>'
+            HTTP_REQUEST_SECONDS.labels(request.method, route, response.status_code).observe(
+                time.perf_counter() - start
+            )
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(REGISTRY), content_type=CONTENT_TYPE_LATEST)
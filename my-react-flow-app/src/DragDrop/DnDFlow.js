@@ -82,6 +82,8 @@ const DnDFlow = ({scenarioToLoad, onScenarioSaved, onFlowRunningChange }) => {
   const [isStart, setisStart] = useState(false);
   const completionStateRef = useRef({ completedNodes: [], failedNodes: [] });
   const [isPaused, setIsPaused] = useState(false);
+  const statusStreamRef = useRef(null);
+  const statusWaitersRef = useRef(new Map());
 
 
   const customOnNodesChange = useCallback((changes) => {
@@ -185,6 +187,64 @@ const isPausedRef = useRef(false);
     return transformedConfig;
   };
 
+  const openStatusStream = () => {
+    if (statusStreamRef.current) return;
+    const query = currentScenarioName ? `?scenario=${encodeURIComponent(currentScenarioName)}` : '';
+    const source = new EventSource(`${API_BASE_URL}/events${query}`);
+    source.addEventListener('status', (event) => {
+      const data = JSON.parse(event.data);
+      // node events of backend runs carry a run_id, device transitions do not
+      if (data.run_id) return;
+      const waiter = statusWaitersRef.current.get(data.node_id);
+      if (waiter) waiter(data.status);
+    });
+    statusStreamRef.current = source;
+  };
+
+  const closeStatusStream = () => {
+    if (statusStreamRef.current) {
+      statusStreamRef.current.close();
+      statusStreamRef.current = null;
+    }
+    statusWaitersRef.current.clear();
+  };
+
+  const waitForNodeStatus = (nodeId, onStatus, timeoutMs) => {
+    let cleanup = () => {};
+    const checkInterval = 500;
+    const promise = new Promise((resolve, reject) => {
+      // time spent paused does not count towards the timeout
+      let waitedMs = 0;
+      const stopCheck = setInterval(() => {
+        if (!isRunningRef.current) {
+          cleanup();
+          reject(new Error('Execution was stopped by user'));
+          return;
+        }
+        if (!isPausedRef.current) waitedMs += checkInterval;
+        if (waitedMs >= timeoutMs) {
+          cleanup();
+          reject(new Error(`timeout after ${timeoutMs / 1000} seconds`));
+        }
+      }, checkInterval);
+      cleanup = () => {
+        clearInterval(stopCheck);
+        statusWaitersRef.current.delete(nodeId);
+      };
+      statusWaitersRef.current.set(nodeId, (status) => {
+        onStatus(status);
+        if (status === 'completed') {
+          cleanup();
+          resolve(status);
+        } else if (status === 'failed') {
+          cleanup();
+          reject(new Error('Device failed'));
+        }
+      });
+    });
+    return { promise, notify: (status) => statusWaitersRef.current.get(nodeId)?.(status) };
+  };
+
   const executeNode = async (node, pathId = null) => {
   console.log(`[${pathId}] Executing node: ${node.id} - ${node.data.label}`);
 
@@ -331,6 +391,7 @@ const isPausedRef = useRef(false);
 
   const executeDeviceNode = async (node, pathId = null) => {
     const { config, originalDeviceId } = node.data;
+    let statusWait = null;
     
     try {
       const transformedConfig = transformConfigForDevice(config);
@@ -344,6 +405,41 @@ const isPausedRef = useRef(false);
         }
       }
       
+      const updateNodeStyle = (currentStatus) => {
+        setNodes(nds => nds.map(n => {
+          if (n.id === node.id) {
+            let backgroundColor, borderColor;
+            switch (currentStatus) {
+              case 'completed':
+                backgroundColor = '#4caf50';
+                borderColor = '#2e7d32';
+                break;
+              case 'failed':
+                backgroundColor = '#f44336';
+                borderColor = '#d32f2f';
+                break;
+              default:
+                backgroundColor = '#ffeb3b';
+                borderColor = '#ff9800';
+            }
+            
+            return {
+              ...n,
+              style: { ...n.style, backgroundColor, border: `2px solid ${borderColor}` }
+            };
+          }
+          return n;
+        }));
+      };
+
+      // register before starting so a fast device cannot finish unnoticed
+      openStatusStream();
+      const maxWaitMs = 300000;
+      statusWait = waitForNodeStatus(node.id, (status) => {
+        console.log(`Device ${node.id} status: ${status}`);
+        updateNodeStyle(status);
+      }, maxWaitMs);
+
       const response = await fetch(`${API_BASE_URL}/start/${originalDeviceId}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
@@ -360,95 +456,36 @@ const isPausedRef = useRef(false);
 
       const result = await response.json();
       console.log('Device start result:', result);
-      
-      let status = 'started';
-      let attempts = 0;
-      const maxAttempts = 300;
-      const pollInterval = 1000;
-      
-      while (status === 'started' && attempts < maxAttempts) {
-        if (!isRunningRef.current) {
-          console.log('Execution was stopped - breaking polling loop');
-          throw new Error('Execution was stopped by user');
-        }
 
-        if (isPausedRef.current) {
-          await new Promise(resolve => setTimeout(resolve, pollInterval));
-          continue;
+      // catch a transition published before the event stream was connected
+      try {
+        const statusResponse = await fetch(`${API_BASE_URL}/get_status/${node.id}`);
+        if (statusResponse.ok) {
+          const statusData = await statusResponse.json();
+          if (statusData.status) statusWait.notify(statusData.status);
         }
-        
-        await new Promise(resolve => setTimeout(resolve, pollInterval));
-        
-        try {
-          const statusResponse = await fetch(`${API_BASE_URL}/get_status/${node.id}`);
-          if (statusResponse.ok) {
-            const statusData = await statusResponse.json();
-            status = statusData.status;
-            
-            console.log(`Device ${node.id} status: ${status} (attempt ${attempts})`);
-            
-            const updateNodeStyle = (currentStatus) => {
-              setNodes(nds => nds.map(n => {
-                if (n.id === node.id) {
-                  let backgroundColor, borderColor;
-                  switch (currentStatus) {
-                    case 'in progress':
-                      backgroundColor = '#ffeb3b';
-                      borderColor = '#ff9800';
-                      break;
-                    case 'completed':
-                      backgroundColor = '#4caf50';
-                      borderColor = '#2e7d32';
-                      break;
-                    case 'failed':
-                      backgroundColor = '#f44336';
-                      borderColor = '#d32f2f';
-                      break;
-                    default:
-                      backgroundColor = '#ffeb3b';
-                      borderColor = '#ff9800';
-                  }
-                  
-                  return {
-                    ...n,
-                    style: { ...n.style, backgroundColor, border: `2px solid ${borderColor}` }
-                  };
-                }
-                return n;
-              }));
-            };
+      } catch (statusError) {
+        console.warn(`Status check failed for device ${originalDeviceId}:`, statusError);
+      }
 
-            updateNodeStyle(status);
-            
-            if (status === 'completed') {
-              console.log(`Device ${originalDeviceId} completed successfully`);
-              return result;
-            } else if (status === 'failed') {
-              throw new Error('Device failed');
-            }
-          }
-        } catch (statusError) {
-          if (statusError.message === 'Device failed') {
-            throw statusError; 
-          }
-          console.warn(`Status check failed for device ${originalDeviceId}:`, statusError);
-        }
-        
-        attempts++;
-        
-        if (attempts % 10 === 0) {
-          console.log(`Waiting for device ${originalDeviceId}... (${attempts}s elapsed)`);
+      try {
+        await statusWait.promise;
+      } catch (waitError) {
+        if (waitError.message.startsWith('timeout')) {
+          throw new Error(`Device ${originalDeviceId} ${waitError.message}`);
         }
+        throw waitError;
       }
-      
-      if (status === 'in progress') {
-        throw new Error(`Device ${originalDeviceId} timeout after ${maxAttempts} seconds`);
-      }
-      
+
+      console.log(`Device ${originalDeviceId} completed successfully`);
       return result;
       
     } catch (error) {
       console.error('Device execution error:', error);
+      if (statusWait) {
+        statusWait.promise.catch(() => {});
+        statusWait.notify('failed');
+      }
       
       setNodes(nds => nds.map(n => {
         if (n.id === node.id) {
@@ -1056,6 +1093,7 @@ const executeConditionNode = async (node, pathId = null) => {
   } finally {
     setisStart(false);
     isRunningRef.current = false;
+    closeStatusStream();
     
     updateExecutionState(prev => ({
       ...prev,
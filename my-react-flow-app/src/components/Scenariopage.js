@@ -3,6 +3,7 @@ import styles from './MyComponent.module.css';
 import axios from 'axios';
 
 const API_BASE_URL = process.env.REACT_APP_API_BASE_URL;
+const PAGE_SIZE = 100;
 
 function Scenariopage({ onScenarioSelect, onCreateNew, scenarioName}) {  
   const [scenarios, setScenarios] = useState([]);
@@ -12,19 +13,22 @@ function Scenariopage({ onScenarioSelect, onCreateNew, scenarioName}) {
   const [newScenarioName, setNewScenarioName] = useState('');
   const [copyingScenario, setCopyingScenario] = useState(null);
   const [copyName, setCopyName] = useState('');
+  const [totalScenarios, setTotalScenarios] = useState(0);
 
   const myRef = useRef(null);
 
-  const fetchScenarios = async () => {
-    setLoading(true);
+  const fetchScenarios = async (offset = 0) => {
+    setLoading(offset === 0);
     setError(null);
     try {
-      const response = await fetch(`${API_BASE_URL}/flow_scenarios`);
+      const response = await fetch(`${API_BASE_URL}/flow_scenarios?offset=${offset}&limit=${PAGE_SIZE}`);
       if (!response.ok) {
         throw new Error('response problem');
       }
       const data = await response.json();
-      setScenarios(data);
+      const names = data.scenarios.map(scenario => scenario.name);
+      setScenarios(prev => offset === 0 ? names : [...prev, ...names]);
+      setTotalScenarios(data.total);
     } catch (error) {
       console.error('Error in fetch', error);
       setError(error.message);
@@ -199,6 +203,11 @@ const startRenaming = (scenarioName, e) => {
               )}
             </div>
           ))}
+          {scenarios.length < totalScenarios && (
+            <button className={styles.create_button} onClick={() => fetchScenarios(scenarios.length)}>
+              LOAD MORE ({totalScenarios - scenarios.length})
+            </button>
+          )}
           <div ref={myRef}></div>
         </div>
       ) : null}
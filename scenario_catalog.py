@@ -0,0 +1,189 @@
+import json
+import time
+
+# Scenario catalog: every saved scenario is a member of both sorted sets, scored by
+# its modification time in CATALOG_KEY and with score 0 (so ordered by name) in
+# CATALOG_BY_NAME_KEY, and has its metadata in a `scenario_meta:<name>` hash.
+# Single config values set outside the editor (uploads) are kept as patches in a
+# `scenario_fields:<name>` hash and applied when the scenario is loaded
+CATALOG_KEY = "scenarios"
+CATALOG_BY_NAME_KEY = "scenarios_by_name"
+LEGACY_LIST_KEY = "scenarios_list"
+
+SORT_ORDERS = ('modified', 'name')
+
+
+def scenario_key(name):
+    return f"scenario_{name}"
+
+
+def meta_key(name):
+    return f"scenario_meta:{name}"
+
+
+def fields_key(name):
+    return f"scenario_fields:{name}"
+
+
+def _field(node_id, field_name):
+    return f"{node_id}\x1f{field_name}"
+
+
+def describe(flow_json, modified=None):
+    """Metadata stored for a scenario document (a JSON string)."""
+    try:
+        flow = json.loads(flow_json)
+    except ValueError:
+        flow = {}
+    return {
+        'modified': modified if modified is not None else time.time(),
+        'size': len(flow_json.encode('utf-8')),
+        'node_count': len(flow.get('nodes', [])),
+        'edge_count': len(flow.get('edges', []))
+    }
+
+
+def _index(pipe, name, meta):
+    pipe.zadd(CATALOG_KEY, {name: meta['modified']})
+    pipe.zadd(CATALOG_BY_NAME_KEY, {name: 0})
+    pipe.delete(meta_key(name))
+    pipe.hset(meta_key(name), mapping=meta)
+
+
+def _unindex(pipe, name):
+    pipe.zrem(CATALOG_KEY, name)
+    pipe.zrem(CATALOG_BY_NAME_KEY, name)
+    pipe.delete(meta_key(name))
+
+
+def exists(redis_client, name):
+    return redis_client.zscore(CATALOG_KEY, name) is not None
+
+
+def save(redis_client, name, flow_json):
+    """
+    Store a scenario document and index it, in one transaction.
+    The document comes from the editor and already holds the patched values.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(scenario_key(name), flow_json)
+    pipe.delete(fields_key(name))
+    _index(pipe, name, describe(flow_json))
+    pipe.execute()
+
+
+def load(redis_client, name):
+    """The scenario document with its field patches applied, or None."""
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.get(scenario_key(name))
+    pipe.hgetall(fields_key(name))
+    flow_json, patches = pipe.execute()
+    if flow_json is None:
+        return None
+    flow = json.loads(flow_json)
+    if patches:
+        for node in flow.get('nodes', []):
+            config = (node.get('data') or {}).get('config') or {}
+            for field_name, item in config.items():
+                value = patches.get(_field(node.get('id'), field_name))
+                if value is not None and isinstance(item, dict):
+                    item['value'] = json.loads(value)
+    return flow
+
+
+def set_field(redis_client, name, node_id, field_name, value):
+    """
+    Set the value of one node config field without rewriting the document.
+    Concurrent calls on different fields do not overwrite each other.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(fields_key(name), _field(node_id, field_name), json.dumps(value))
+    pipe.zadd(CATALOG_KEY, {name: time.time()}, xx=True)
+    pipe.hset(meta_key(name), 'modified', time.time())
+    pipe.execute()
+
+
+def delete(redis_client, name):
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(scenario_key(name))
+    pipe.delete(fields_key(name))
+    _unindex(pipe, name)
+    pipe.execute()
+
+
+def rename(redis_client, old_name, new_name):
+    """Rename a scenario; the caller checks that new_name is free."""
+    meta = redis_client.hgetall(meta_key(old_name))
+    has_fields = redis_client.exists(fields_key(old_name))
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.rename(scenario_key(old_name), scenario_key(new_name))
+    if has_fields:
+        pipe.rename(fields_key(old_name), fields_key(new_name))
+    _unindex(pipe, old_name)
+    if meta:
+        meta['modified'] = time.time()
+        _index(pipe, new_name, meta)
+    pipe.execute()
+    if not meta:
+        # scenario saved before the catalog existed
+        _reindex(redis_client, new_name)
+
+
+def _reindex(redis_client, name):
+    """Index a stored scenario; returns False if `scenario_<name>` does not exist."""
+    flow_json = redis_client.get(scenario_key(name))
+    if flow_json is None:
+        return False
+    pipe = redis_client.pipeline(transaction=True)
+    _index(pipe, name, describe(flow_json))
+    pipe.execute()
+    return True
+
+
+def names(redis_client):
+    """Every scenario name, most recently modified first."""
+    return redis_client.zrevrange(CATALOG_KEY, 0, -1)
+
+
+def page(redis_client, offset=0, limit=50, sort='modified'):
+    """
+    One page of the catalog with metadata, sorted by modification time (newest
+    first) or by name. Returns (entries, total).
+    """
+    stop = offset + limit - 1
+    if sort == 'name':
+        page_names = redis_client.zrange(CATALOG_BY_NAME_KEY, offset, stop)
+    else:
+        page_names = redis_client.zrevrange(CATALOG_KEY, offset, stop)
+
+    pipe = redis_client.pipeline()
+    for name in page_names:
+        pipe.hgetall(meta_key(name))
+    pipe.zcard(CATALOG_KEY)
+    results = pipe.execute()
+    total = results.pop()
+
+    entries = []
+    for name, meta in zip(page_names, results):
+        entries.append({
+            'name': name,
+            'modified': float(meta.get('modified', 0)),
+            'size': int(meta.get('size', 0)),
+            'node_count': int(meta.get('node_count', 0)),
+            'edge_count': int(meta.get('edge_count', 0))
+        })
+    return entries, total
+
+
+def migrate_legacy_list(redis_client):
+    """
+    Move scenarios listed in the old `scenarios_list` list into the catalog.
+    Safe to run on every start; it is a no-op once the list is gone.
+    """
+    legacy_names = set(redis_client.lrange(LEGACY_LIST_KEY, 0, -1))
+    migrated = 0
+    for name in legacy_names:
+        if not exists(redis_client, name) and _reindex(redis_client, name):
+            migrated += 1
+    redis_client.delete(LEGACY_LIST_KEY)
+    return migrated
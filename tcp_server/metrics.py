@@ -0,0 +1,81 @@
+"""
+Prometheus metrics of the gateway, served in the text exposition format on
+METRICS_PORT (/metrics) by a small HTTP server thread next to the event loop.
+"""
+import os
+import time
+
+import redis.asyncio as redis
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+METRICS_PORT = int(os.getenv("GATEWAY_METRICS_PORT", 9101))
+# Buckets in seconds: Redis round trips at the low end, long device commands at the high end
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+ACK_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REDIS_COMMAND_SECONDS = Histogram(
+    "gateway_redis_command_duration_seconds",
+    "Redis round trip time, by command (PIPELINE/MULTI for batches)",
+    ["command"], buckets=REDIS_BUCKETS
+)
+COMMAND_ACK_SECONDS = Histogram(
+    "gateway_command_ack_seconds",
+    "Time from sending a command to a device until its ack arrives",
+    ["command", "status"], buckets=ACK_BUCKETS
+)
+COMMANDS_SENT = Counter(
+    "gateway_commands_sent_total", "Commands sent to devices, resends after a reconnect included",
+    ["command"]
+)
+CONNECTED_DEVICES = Gauge(
+    "gateway_connected_devices", "Devices with an open connection to this gateway"
+)
+SESSIONS = Gauge(
+    "gateway_sessions", "Device sessions, connected or waiting for their device to reconnect"
+)
+REDIRECTS = Counter(
+    "gateway_redirects_total", "Connecting devices sent to the gateway that owns them"
+)
+FILES_SENT = Counter("gateway_files_sent_total", "Assets pushed to devices", ["rendered"])
+FILE_BYTES_SENT = Counter("gateway_file_bytes_sent_total", "Bytes of the assets pushed to devices")
+FILES_SKIPPED = Counter(
+    "gateway_files_skipped_total", "Assets not pushed because the device already had them"
+)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing every command and pipeline it sends."""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            command = "MULTI" if self.is_transaction else "PIPELINE"
+            REDIS_COMMAND_SECONDS.labels(command).observe(time.perf_counter() - start)
+
+
+def command_label(command_data):
+    """Bounded label for a command: hints are counted together."""
+    command = str(command_data.get("command"))
+    return "hint" if command.startswith("hint") else command
+
+
+def start_metrics_server(port=METRICS_PORT):
+    start_http_server(port)
+    print(f"Metrics on :{port}/metrics")
@@ -1,131 +1,981 @@
-import socket
-import threading
+import asyncio
 import json
-import redis
 import time
 import os
-import requests
-import os
+import uuid
+import hashlib
+import re
+import socket
+from redis.exceptions import ResponseError, WatchError
+from protocol import CHUNK_SIZE, encode_message, read_message, write_message
+import metrics
 
 HOST = '0.0.0.0'  # Listen on all interfaces
 PORT = 65432      # Port to listen on
+# Pending connections the kernel queues while we accept; large enough for a whole
+# venue reconnecting at once after a power cut (capped by net.core.somaxconn)
+ACCEPT_BACKLOG = int(os.getenv("GATEWAY_ACCEPT_BACKLOG", 4096))
 connected_devices = {}
-backend_url = os.getenv("REACT_APP_API_BASE_URL")
+# The backend's static folder (uploads/ and renders/), mounted read-only, from
+# which assets are streamed straight to the devices
+ASSET_ROOT = os.getenv("GATEWAY_ASSET_ROOT", "/srv/static")
+UPLOADS_PREFIX = "/static/uploads/"
+# Uploads named after their SHA-256 never change, so a device that has one keeps it
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+# (path, mtime, size) -> sha256 of the assets sent so far
+ASSET_DIGEST_CACHE_SIZE = 1024
+asset_digests = {}
 # Redis client
-r = redis.Redis(host='redis', port=6379, decode_responses=True)
+r = metrics.InstrumentedRedis(host='redis', port=6379, decode_responses=True)
+# Pub/sub channel announcing every flow_execution:<node_id> change
+FLOW_EVENTS_CHANNEL = "flow_events"
+# Pub/sub channel on which the backend announces the device id of every queued command
+COMMANDS_CHANNEL = "device_commands"
+# Seconds a connection sleeps without a wake-up before it re-checks its queues anyway
+COMMAND_WAIT_TIMEOUT = 30
+# Command queues are the `<device_id>:commands` streams, read by every gateway in
+# one consumer group, each gateway under its own consumer name (set GATEWAY_ID
+# when several gateways share a host). An entry stays pending until the device
+# acks it, so a gateway crashing between reading and sending loses nothing: its
+# entries are claimed by whichever gateway serves the device once they were idle
+# CLAIM_IDLE seconds. Gateways renew the entries in flight well before that
+COMMANDS_GROUP = "gateways"
+GATEWAY_ID = os.getenv("GATEWAY_ID") or socket.gethostname()
+CLAIM_IDLE = int(os.getenv("GATEWAY_CLAIM_IDLE", 60))
+# Commands sent to a device before their acks are in; later ones (hints, resets)
+# no longer wait behind a long-running start
+COMMAND_WINDOW = int(os.getenv("GATEWAY_COMMAND_WINDOW", 4))
+# device_id -> asyncio.Event of the connection serving it
+command_wakeups = {}
+# Seconds the session of a disconnected device is kept for it to reconnect; its
+# queues are held meanwhile. Keep well below DEVICE_TTL
+RESUME_GRACE = int(os.getenv("GATEWAY_RESUME_GRACE", 30))
+# device_id -> DeviceSession, connected or waiting for its device to come back
+sessions = {}
+metrics.SESSIONS.set_function(lambda: len(sessions))
+metrics.CONNECTED_DEVICES.set_function(
+    lambda: sum(1 for session in list(sessions.values()) if session.writer is not None)
+)
+# Fields of the initial device message describing the device's session, not the device
+HELLO_FIELDS = ("cached_assets", "acks", "running", "redirected")
+# Device registry: `device:<device_id>` entries indexed by the DEVICES_INDEX set.
+# Entries expire DEVICE_TTL seconds after the last refresh, so devices of a
+# crashed gateway disappear on their own
+DEVICES_INDEX = "devices"
+DEVICE_EVENTS_CHANNEL = "device_events"
+DEVICE_TTL = int(os.getenv("GATEWAY_DEVICE_TTL", 60))
+# Heartbeats: the gateway pings every device each HEARTBEAT_INTERVAL seconds and
+# drops the connection after HEARTBEAT_MISSES unanswered pings (the session then
+# waits RESUME_GRACE for the device). RTT statistics go to `device_health:<id>`
+HEARTBEAT_INTERVAL = float(os.getenv("GATEWAY_HEARTBEAT_INTERVAL", 5))
+HEARTBEAT_MISSES = int(os.getenv("GATEWAY_HEARTBEAT_MISSES", 3))
+RTT_SMOOTHING = 0.2  # weight of the newest sample in the moving average
+# Command traces: the hops of every command for a node are appended to the
+# capped `trace:<node_id>` stream; same limits as command_trace.py in the backend
+TRACE_MAXLEN = 200
+TRACE_TTL = 24 * 3600
+# Sharding: several gateways share the devices. Each one registers itself as
+# `gateway:<GATEWAY_ID>` with the address devices reach it on (set
+# GATEWAY_ADVERTISE_HOST/PORT when running more than one) and owns the devices
+# it serves through `device_owner:<device_id>` leases. A device is served by the
+# live owner of its lease, else by the gateway rendezvous hashing picks among the
+# live ones; any other gateway redirects it there. The backend wakes the owner
+# only, on its inbox channel. When a gateway dies its registration expires within
+# GATEWAY_TTL, its devices reconnect, are placed on the remaining gateways and
+# these claim its pending commands (CLAIM_IDLE)
+GATEWAYS_INDEX = "gateways"
+GATEWAY_TTL = int(os.getenv("GATEWAY_TTL", 15))
+ADVERTISE_HOST = os.getenv("GATEWAY_ADVERTISE_HOST") or socket.gethostname()
+ADVERTISE_PORT = int(os.getenv("GATEWAY_ADVERTISE_PORT", PORT))
+LEASE_TTL = DEVICE_TTL
+# Channel on which the backend wakes the devices this gateway owns
+INBOX_CHANNEL = f"{COMMANDS_CHANNEL}:{GATEWAY_ID}"
+
+
+class LeaseLost(ConnectionError):
+    """Another gateway took over the device."""
 
 
-def send_file(client_socket, image_path):
-    """Send a file to the client over the same socket using JSON header + raw bytes"""
+async def send_file(writer, asset_url, display=None):
+    """
+    Stream an uploaded asset from the shared volume to the client: a JSON header
+    with its size and SHA-256, then the raw bytes, sent with sendfile(2) where the
+    transport supports it (bounded chunks otherwise) so the file is never held in
+    memory. Returns False if the asset is not on the volume.
+    """
+    path = asset_path(asset_url, display)
     try:
-        response = requests.get(f'{backend_url}/{image_path}')
-        image_data = response.content
-        filesize = len(image_data)
+        f = open(path, "rb") if path else None
+    except OSError as e:
+        print(f"[!] Error opening {path}: {e}")
+        f = None
+    if f is None:
+        print(f"[!] Asset {asset_url} not available under {ASSET_ROOT}")
+        return False
+    with f:
+        stat = os.fstat(f.fileno())
+        filesize = stat.st_size
         header = {
             "type": "file",
-            "filename": image_path,
+            "filename": asset_url,
             "size": filesize,
+            "sha256": await asset_digest(path, stat),
+            "rendered": path.startswith(os.path.join(ASSET_ROOT, "renders", "")),
         }
-        # Send header first, terminated by newline
-        client_socket.sendall((json.dumps(header) + "\n").encode("utf-8"))
-        client_socket.sendall(image_data)
-        #with open(filename, "rb") as f:
-            #while chunk := f.read(4096):
-                #client_socket.sendall(chunk)
-
-        print(f"[+] Sent {image_path} ({filesize} bytes)")
-    except Exception as e:
-        print(f"[!] Error sending file: {e}")
+        # Send the header frame first, the raw bytes follow it on the stream
+        writer.write(encode_message(header))
+        await writer.drain()
+        await asyncio.get_running_loop().sendfile(writer.transport, f, 0, filesize)
+    metrics.FILES_SENT.labels(str(header["rendered"]).lower()).inc()
+    metrics.FILE_BYTES_SENT.inc(filesize)
+    print(f"[+] Sent {asset_url} ({filesize} bytes)")
+    return True
 
 
-def start_server(host, port):
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((host, port))
-    server_socket.listen(5)  # Allow up to 5 pending connections
-    print(f"Listening on {host}:{port}")
+def asset_path(asset_url, display=None):
+    """
+    File on the shared volume serving an upload URL (/static/uploads/<file>): the
+    render for the device's display profile when the backend made one, else the
+    upload itself. None if neither exists.
+    """
+    if not isinstance(asset_url, str) or not asset_url.startswith(UPLOADS_PREFIX):
+        return None
+    filename = os.path.basename(asset_url)
+    if not filename or filename != asset_url[len(UPLOADS_PREFIX):]:
+        return None
+    candidates = []
+    if isinstance(display, dict) and display.get("format") in ("RGB", "L", "1"):
+        profile = f"{display.get('width')}x{display.get('height')}-{display['format']}"
+        rendered = os.path.splitext(filename)[0] + ".png"
+        candidates.append(os.path.join(ASSET_ROOT, "renders", profile, rendered))
+    candidates.append(os.path.join(ASSET_ROOT, "uploads", filename))
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+async def asset_digest(path, stat):
+    """SHA-256 of an asset file, computed in bounded chunks and cached per file version."""
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = asset_digests.get(key)
+    if digest is None:
+        digest = await asyncio.to_thread(hash_file, path)
+        if len(asset_digests) >= ASSET_DIGEST_CACHE_SIZE:
+            asset_digests.pop(next(iter(asset_digests)))
+        asset_digests[key] = digest
+    return digest
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def command_assets(command_data):
+    """Upload URLs referenced by a start or prefetch command's config, in config order."""
+    if command_data.get("command") not in ("start", "prefetch"):
+        return []
+    config = command_data.get("config")
+    if not isinstance(config, dict):
+        return []
+    return [
+        value for value in config.values()
+        if isinstance(value, str) and value.startswith(UPLOADS_PREFIX)
+    ]
 
-    while True:
-        client_socket, addr = server_socket.accept()
-        client_handler = threading.Thread(target=handle_client, args=(client_socket, addr))
-        client_handler.start()
 
+async def start_server(host, port, backlog=ACCEPT_BACKLOG):
+    metrics.start_metrics_server()
+    registration = asyncio.create_task(keep_gateway_registered())
+    listener = asyncio.create_task(listen_command_notifications())
+    server = await asyncio.start_server(handle_client, host, port, backlog=backlog)
+    print(f"Listening on {host}:{port} (backlog {backlog})")
 
-def handle_client(client_socket, addr):
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        listener.cancel()
+        registration.cancel()
+        await release_leases(list(connected_devices))
+        for device_id in list(connected_devices):
+            await remove_device(device_id)
+        await unregister_gateway()
+
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
     print(f"Accepted connection from {addr}")
     try:
-        device_info = json.loads(client_socket.recv(1024).decode('utf-8'))
+        device_info = await read_message(reader)
+        if not isinstance(device_info, dict):
+            raise ConnectionError("no device info received")
+        # session state the device reports on (re)connect; not part of the registry
+        hello = {field: device_info.pop(field, None) for field in HELLO_FIELDS}
         num_nodes = device_info.get("num_nodes", 1)
         device_name = device_info.get("device_name", "")
-        device_id = f"{addr[0]}:{device_name}"
+        # devices may pin their id; by default it follows their address
+        device_id = device_info.get("device_id") or f"{addr[0]}:{device_name}"
+        if num_nodes > 1:
+            node_device_ids = [f"{device_id}_{i+1}" for i in range(num_nodes)]
+        else:
+            node_device_ids = [device_id]
+        session = sessions.get(device_id)
+        if session is not None and not session.resumable(device_info, node_device_ids):
+            # another device took the id: end its session before registering this
+            # one, as ending it unregisters the device and releases its leases
+            await session.end()
+        owner = await place_device(node_device_ids, hello.get("redirected"))
+        if owner is not None:
+            print(f"Redirecting {device_id} to gateway {owner['gateway_id']}")
+            metrics.REDIRECTS.inc()
+            await write_message(writer, dict(owner, type="redirect"))
+            writer.close()
+            return
         if num_nodes > 1:
-            for i in range(num_nodes):
+            for i, node_device_id in enumerate(node_device_ids):
                 instance_device_info = device_info.copy()
                 instance_device_info["device_name"] = device_name+f"_{i+1}"
-                update_device_info(device_id+f"_{i+1}", instance_device_info)
+                await update_device_info(node_device_id, instance_device_info)
         else:
-            update_device_info(device_id, device_info)
+            await update_device_info(device_id, device_info)
     except Exception as e:
         print(f"[!] Error receiving initial device info: {e}")
+        writer.close()
         return
 
-    index = 0
-    while True:
+    session = sessions.get(device_id)
+    if session is not None and session.resumable(device_info, node_device_ids):
+        print(f"Resuming session of {device_id}")
+    else:
+        session = DeviceSession(device_id, node_device_ids, device_info.get("device_uid"))
+        sessions[device_id] = session
+
+    try:
+        await session.attach(reader, writer, hello)
+        await session.run()
+    except LeaseLost as e:
+        print(f"Handing {device_id} over: {e}")
+        await session.release()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        writer.close()
+        session.detach(writer)
+
+
+class DeviceSession():
+    """
+    Serves one device. Every logical sub-node (`<device_id>_<i>` when the device
+    registers num_nodes > 1) has its own queue consumer and keeps up to `window`
+    commands in flight, all multiplexed over the one socket. Acks may come back in
+    any order and are matched by their command_id.
+
+    The session outlives its connection by RESUME_GRACE seconds: meanwhile the
+    queues are held and the in-flight commands kept, and a reconnecting device
+    picks up where it left off. On reconnect it reports the acks it could not
+    deliver and the commands it is still running; the other in-flight commands
+    never reached it and are sent again.
+    """
+
+    def __init__(self, device_id, node_device_ids, device_uid=None, window=COMMAND_WINDOW):
+        self.reader = None
+        self.writer = None
+        self.device_id = device_id
+        self.device_uid = device_uid
+        self.node_device_ids = node_device_ids
+        self.wakeups = {node_device_id: asyncio.Event() for node_device_id in node_device_ids}
+        self.slots = {
+            node_device_id: asyncio.Semaphore(window) for node_device_id in node_device_ids
+        }
+        # command_id -> (sub-node device id, stream entry id, command data), in dispatch order
+        self.in_flight = {}
+        self.streams = {node_device_id: CommandStream(node_device_id) for node_device_id in node_device_ids}
+        self.sent_at = {}    # command_id -> monotonic time it was first sent to the device
+        self.write_lock = asyncio.Lock()
+        # content-addressed assets the device holds, reported at connect or pushed since
+        self.device_assets = set()
+        self.tasks = []
+        self.expiry = None
+        self.pings = {}  # seq -> monotonic send time of the unanswered pings
+        self.rtt = {}    # RTT statistics of the current connection
+        for node_device_id, wakeup in self.wakeups.items():
+            command_wakeups[node_device_id] = wakeup
+
+    def resumable(self, device_info, node_device_ids):
+        """Whether a new connection is the same device coming back."""
+        device_uid = device_info.get("device_uid")
+        if self.device_uid and device_uid and device_uid != self.device_uid:
+            return False
+        return node_device_ids == self.node_device_ids
+
+    async def attach(self, reader, writer, hello):
+        """Serve the session over a new connection."""
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        # a connection the device replaced may not have noticed it is dead yet
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        self.reader, self.writer = reader, writer
+        self.device_assets = set(hello.get("cached_assets") or [])
+        self.pings, self.rtt = {}, {}
+        await set_device_health(self.node_device_ids, {"state": "online", "last_seen": time.time()})
+        await self.resume(hello.get("acks") or [], hello.get("running") or [])
+
+    async def resume(self, acks, running):
+        for ack in acks:
+            await self.handle_ack(ack)
+        running = set(running)
+        for command_id, (node_device_id, _, command_data) in list(self.in_flight.items()):
+            if command_id not in running:
+                print(f"Sending {command_id} again to {self.device_id}")
+                await self.send_command(node_device_id, command_data)
+
+    def detach(self, writer):
+        """The connection `writer` belongs to is gone; wait RESUME_GRACE for the device."""
+        if self.writer is not writer:
+            return  # already replaced by a newer connection
+        self.reader = self.writer = None
+        if sessions.get(self.device_id) is self:
+            self.expiry = asyncio.create_task(self.expire_after(RESUME_GRACE))
+
+    async def expire_after(self, delay):
+        await set_device_health(self.node_device_ids, {"state": "reconnecting"})
+        await refresh_devices(self.node_device_ids)
+        await self.renew_claims()
+        try:
+            await renew_leases(self.node_device_ids)
+        except LeaseLost as e:
+            print(f"Handing {self.device_id} over: {e}")
+            await self.release()
+            return
+        await asyncio.sleep(delay)
+        self.expiry = None
+        await self.end()
+
+    async def end(self):
+        """Drop the session: unregister the device and fail what it never acked."""
+        if sessions.get(self.device_id) is self:
+            del sessions[self.device_id]
+        if self.expiry is not None and self.expiry is not asyncio.current_task():
+            self.expiry.cancel()
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        for node_device_id, wakeup in self.wakeups.items():
+            if command_wakeups.get(node_device_id) is wakeup:
+                del command_wakeups[node_device_id]
+            await remove_device(node_device_id)
+        await self.fail_in_flight()
+        await release_leases(self.node_device_ids)
+
+    async def release(self):
+        """
+        The device is served by another gateway now: forget the session without
+        touching the registry, the node statuses or the commands in flight, which
+        the new owner claims once this gateway stops renewing them.
+        """
+        if sessions.get(self.device_id) is self:
+            del sessions[self.device_id]
+        if self.expiry is not None and self.expiry is not asyncio.current_task():
+            self.expiry.cancel()
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        for node_device_id, wakeup in self.wakeups.items():
+            if command_wakeups.get(node_device_id) is wakeup:
+                del command_wakeups[node_device_id]
+            connected_devices.pop(node_device_id, None)
+        self.in_flight = {}
+        self.sent_at = {}
+
+    async def run(self):
+        """Dispatch commands and receive acks until the connection fails."""
+        tasks = self.tasks = [
+            asyncio.create_task(self.dispatch_commands(index, node_device_id))
+            for index, node_device_id in enumerate(self.node_device_ids)
+        ]
+        tasks.append(asyncio.create_task(self.receive_messages()))
+        tasks.append(asyncio.create_task(self.keep_registered()))
+        tasks.append(asyncio.create_task(self.heartbeat()))
         try:
-            if num_nodes > 1:
-                command=get_device_command(f"{device_id}_{index+1}")
-                index = (index+1) % num_nodes
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled():
+                    task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def dispatch_commands(self, index, node_device_id):
+        """Queue consumer of one sub-node; `index` is its position among the sub-nodes."""
+        slots = self.slots[node_device_id]
+        while True:
+            # only read a command once it can be sent right away
+            await slots.acquire()
+            try:
+                entry_id, command = await wait_device_command(
+                    self.streams[node_device_id], self.wakeups[node_device_id]
+                )
+            except BaseException:
+                slots.release()
+                raise
+            print(f"Got command {command}")
+            # an entry delivered again keeps its command_id, so the device recognizes it
+            command_data = parse_command(command, f"{node_device_id}/{entry_id}")
+            if command_data["command_id"] in self.in_flight:
+                slots.release()  # already sent by this session
+                continue
+            command_data["index"] = index
+            self.in_flight[command_data["command_id"]] = (node_device_id, entry_id, command_data)
+            self.sent_at[command_data["command_id"]] = time.monotonic()
+            await trace_command(command_data, "dequeued", device_id=node_device_id)
+            node_id = command_data["node_id"]
+            if node_id:
+                await set_node_status(
+                    node_id, "started", command_data.get("scenario_name"), self.device_id
+                )
+            await self.send_command(node_device_id, command_data)
+
+    async def send_command(self, node_device_id, command_data):
+        async with self.write_lock:
+            # push the assets first so the device does not download them itself
+            display = connected_devices.get(node_device_id, {}).get("display")
+            for asset_url in command_assets(command_data):
+                name = os.path.basename(asset_url)
+                if name in self.device_assets:
+                    metrics.FILES_SKIPPED.inc()
+                    continue
+                if await send_file(self.writer, asset_url, display) and \
+                        CONTENT_ADDRESSED_NAME.match(name):
+                    self.device_assets.add(name)
+            await write_message(self.writer, command_data)
+        metrics.COMMANDS_SENT.labels(metrics.command_label(command_data)).inc()
+        await trace_command(command_data, "sent")
+
+    async def keep_registered(self):
+        """Refresh the registry entries and the claims on in-flight commands well before they expire."""
+        while True:
+            await asyncio.sleep(min(DEVICE_TTL, CLAIM_IDLE) / 3)
+            await renew_leases(self.node_device_ids)
+            await refresh_devices(self.node_device_ids)
+            await self.renew_claims()
+
+    async def renew_claims(self):
+        """Reset the idle time of the entries in flight, so no other gateway claims them."""
+        entry_ids = {}
+        for node_device_id, entry_id, _ in self.in_flight.values():
+            entry_ids.setdefault(node_device_id, []).append(entry_id)
+        for node_device_id, ids in entry_ids.items():
+            await self.streams[node_device_id].renew(ids)
+
+    async def heartbeat(self, interval=HEARTBEAT_INTERVAL, misses=HEARTBEAT_MISSES):
+        """
+        Ping the device; a device that stops answering is treated as disconnected.
+        The first ping goes out right away, the device sets its read timeout from it.
+        """
+        seq = 0
+        while True:
+            if len(self.pings) >= misses:
+                raise ConnectionError(f"{len(self.pings)} heartbeats missed")
+            if self.pings:
+                await set_device_health(self.node_device_ids, {"missed": len(self.pings)})
+            seq += 1
+            self.pings[seq] = time.monotonic()
+            async with self.write_lock:
+                await write_message(self.writer, {
+                    "type": "ping", "seq": seq, "interval": interval, "misses": misses
+                })
+            await asyncio.sleep(interval)
+
+    async def handle_pong(self, pong):
+        sent = self.pings.get(pong.get("seq"))
+        if sent is None:
+            return
+        # an answer also vouches for the older pings it overtook
+        self.pings = {seq: t for seq, t in self.pings.items() if seq > pong["seq"]}
+        rtt = (time.monotonic() - sent) * 1000
+        stats = self.rtt
+        stats["samples"] = stats.get("samples", 0) + 1
+        stats["rtt_ms"] = round(rtt, 2)
+        stats["rtt_avg_ms"] = round(
+            rtt if stats["samples"] == 1
+            else stats["rtt_avg_ms"] + RTT_SMOOTHING * (rtt - stats["rtt_avg_ms"]), 2
+        )
+        stats["rtt_min_ms"] = round(min(rtt, stats.get("rtt_min_ms", rtt)), 2)
+        stats["rtt_max_ms"] = round(max(rtt, stats.get("rtt_max_ms", rtt)), 2)
+        await set_device_health(
+            self.node_device_ids, dict(stats, state="online", last_seen=time.time(), missed=0)
+        )
+
+    async def receive_messages(self):
+        while True:
+            message = await read_message(self.reader)
+            if message is None:
+                raise ConnectionError("connection closed by device")
+            if message.get("type") == "pong":
+                await self.handle_pong(message)
+                continue
+            print(message)
+            if message.get("type") == "progress":
+                await self.handle_progress(message)
             else:
-                command=get_device_command(device_id)        
-            if command:
-                print(f"Got command {command}")
-                command_data = json.loads(command)
-                command_data["index"] = index
-                command = json.dumps(command_data)
-                print(f"Got command {command}")
-                node_id = command_data["node_id"]
-                r.set(f"flow_execution:{node_id}", "started")
-                client_socket.sendall(command.encode("utf-8"))
-                ack = json.loads(client_socket.recv(1024).decode('utf-8'))
-                print(ack)
-                if ack["status"] == "success":
-                    r.set(f"flow_execution:{ack['node_id']}", "completed")
+                await self.handle_ack(message)
+
+    async def handle_ack(self, ack):
+        command_id = ack.get("command_id")
+        if command_id is None and self.in_flight:
+            # devices that do not echo command ids ack in order
+            command_id = next(iter(self.in_flight))
+        entry = self.in_flight.pop(command_id, None)
+        if entry is None:
+            print(f"[!] Ack for unknown command {command_id} from {self.device_id}")
+            return
+        node_device_id, entry_id, command_data = entry
+        self.slots[node_device_id].release()
+        sent = self.sent_at.pop(command_id, None)
+        if sent is not None:
+            metrics.COMMAND_ACK_SECONDS.labels(
+                metrics.command_label(command_data), ack.get("status") or "unknown"
+            ).observe(time.monotonic() - sent)
+
+        timing = ack.get("timing") if isinstance(ack.get("timing"), dict) else {}
+        await trace_command(
+            command_data, "acked", status=ack.get("status"), error=ack.get("error"),
+            device_wait_ms=timing.get("wait_ms"), device_run_ms=timing.get("run_ms")
+        )
+
+        node_id = ack.get("node_id") or command_data["node_id"]
+        if node_id:
+            status = "completed" if ack.get("status") == "success" else "failed"
+            await set_node_status(node_id, status, command_data.get("scenario_name"), self.device_id)
+        # only once its outcome is stored: a crash before this delivers it again
+        await self.streams[node_device_id].ack(entry_id)
+
+    async def handle_progress(self, progress):
+        """Relay what a running command reports to /events, without changing its status."""
+        entry = self.in_flight.get(progress.get("command_id"))
+        if entry is None:
+            return
+        _, _, command_data = entry
+        node_id = command_data["node_id"]
+        if not node_id:
+            return
+        details = {
+            key: value for key, value in progress.items()
+            if key not in ("type", "command_id", "node_id")
+        }
+        await publish_node_event(
+            node_id, "progress", command_data.get("scenario_name"), self.device_id,
+            progress=details
+        )
+
+    async def fail_in_flight(self):
+        """
+        Commands still in flight when the session ends will never be acked: their
+        nodes fail and the entries are removed, so they are not delivered again.
+        """
+        in_flight, self.in_flight = self.in_flight, {}
+        self.sent_at = {}
+        for node_device_id, entry_id, command_data in in_flight.values():
+            await self.streams[node_device_id].ack(entry_id)
+            await trace_command(command_data, "failed", reason="device disconnected")
+            if command_data["node_id"]:
+                await set_node_status(
+                    command_data["node_id"], "failed",
+                    command_data.get("scenario_name"), self.device_id
+                )
+
+
+async def listen_command_notifications():
+    """
+    Wake the connection serving a device whenever the backend queues a command for it.
+    One subscription serves every connection, so idle devices cost no Redis traffic.
+    """
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            # the inbox, plus the shared channel for devices no gateway owned yet
+            await pubsub.subscribe(INBOX_CHANNEL, COMMANDS_CHANNEL)
+            # notifications may have been lost while (re)subscribing
+            for wakeup in command_wakeups.values():
+                wakeup.set()
+            async for message in pubsub.listen():
+                wakeup = command_wakeups.get(message["data"])
+                if wakeup:
+                    wakeup.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[!] Command notification listener error: {e}")
+            await asyncio.sleep(1)
+
+
+class CommandStream():
+    """
+    This gateway's consumer of one device's command stream. Reads, in order:
+    entries left pending to this consumer by a previous run of the gateway,
+    entries another consumer left idle for CLAIM_IDLE seconds, then new entries.
+    """
+
+    def __init__(self, device_id):
+        self.key = f"{device_id}:commands"
+        self.ready = False
+        self.backlog = "0"  # position in this consumer's own pending entries; None once read
+
+    async def read(self):
+        """Next (entry id, command) for this gateway, or None if there is none."""
+        if not self.ready:
+            try:
+                await r.xgroup_create(self.key, COMMANDS_GROUP, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self.ready = True
+        while self.backlog is not None:
+            entries = await self._entries(
+                await r.xreadgroup(COMMANDS_GROUP, GATEWAY_ID, {self.key: self.backlog}, count=1)
+            )
+            if not entries:
+                self.backlog = None
+                break
+            self.backlog = entries[0][0]
+            if entries[0][1] is not None:
+                # reading it again does not reset its idle time, which a claim would take for death
+                await self.renew([entries[0][0]])
+                return entries[0]
+        claimed = await r.xautoclaim(
+            self.key, COMMANDS_GROUP, GATEWAY_ID, CLAIM_IDLE * 1000, count=1
+        )
+        for entry_id, fields in claimed[1]:
+            print(f"Claimed {entry_id} of {self.key} after {CLAIM_IDLE}s idle")
+            return entry_id, fields["command"]
+        entries = await self._entries(
+            await r.xreadgroup(COMMANDS_GROUP, GATEWAY_ID, {self.key: ">"}, count=1)
+        )
+        return entries[0] if entries else None
+
+    async def _entries(self, response):
+        """(entry id, command) pairs of an XREADGROUP reply; None for deleted entries."""
+        entries = []
+        for _, stream_entries in response or []:
+            for entry_id, fields in stream_entries:
+                if not fields:
+                    # deleted while pending: nothing left to deliver
+                    await self.ack(entry_id)
+                    entries.append((entry_id, None))
                 else:
-                    r.set(f"flow_execution:{ack['node_id']}", "failed")
-                
+                    entries.append((entry_id, fields["command"]))
+        return entries
+
+    async def renew(self, entry_ids):
+        await r.xclaim(self.key, COMMANDS_GROUP, GATEWAY_ID, 0, entry_ids, justid=True)
+
+    async def ack(self, entry_id):
+        """The command is done: drop it from the pending list and the stream."""
+        pipe = r.pipeline()
+        pipe.xack(self.key, COMMANDS_GROUP, entry_id)
+        pipe.xdel(self.key, entry_id)
+        await pipe.execute()
+
+
+async def wait_device_command(stream, wakeup, timeout=COMMAND_WAIT_TIMEOUT):
+    """
+    Wait until the device has a command for this gateway and read it. The stream
+    is only read when its wake-up fires (or after `timeout` as a safety net, which
+    also picks up entries to claim), never polled.
+    """
+    while True:
+        # clear before reading: an add racing with the read sets it again
+        wakeup.clear()
+        entry = await stream.read()
+        if entry:
+            return entry
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def parse_command(command, command_id=None):
+    """
+    Decode a queued command. Bare commands like "reset" or "hint1" are wrapped
+    so every command sent to a device has the same shape, including the
+    command_id its ack must echo (`command_id`, a new one if not given).
+    """
+    try:
+        command_data = json.loads(command)
+    except ValueError:
+        command_data = None
+    if not isinstance(command_data, dict):
+        command_data = {"command": command}
+    command_data.setdefault("config", {})
+    command_data.setdefault("node_id", None)
+    command_data.setdefault("command_id", command_id or uuid.uuid4().hex)
+    return command_data
+
+
+async def set_node_status(node_id, status, scenario_name=None, device_id=None):
+    """
+    Store the execution status of a node and announce the change on FLOW_EVENTS_CHANNEL.
+    """
+    pipe = r.pipeline()
+    pipe.set(f"flow_execution:{node_id}", status)
+    pipe.publish(FLOW_EVENTS_CHANNEL, json.dumps(node_event(node_id, status, scenario_name, device_id)))
+    await pipe.execute()
+
+
+async def trace_command(command_data, stage, **fields):
+    """
+    Append one hop of a command to its node's trace stream. Commands without a
+    node_id or trace_id (bare commands like "reset") are not traced.
+    """
+    node_id = command_data.get("node_id")
+    trace_id = command_data.get("trace_id")
+    if not node_id or not trace_id:
+        return
+    event = {key: value for key, value in fields.items() if value is not None}
+    event.update(trace_id=trace_id, stage=stage, ts=time.time())
+    key = f"trace:{node_id}"
+    pipe = r.pipeline()
+    pipe.xadd(key, event, maxlen=TRACE_MAXLEN, approximate=True)
+    pipe.expire(key, TRACE_TTL)
+    await pipe.execute()
+
+
+async def publish_node_event(node_id, status, scenario_name=None, device_id=None, **fields):
+    """Announce a node event on FLOW_EVENTS_CHANNEL without storing a new status."""
+    event = node_event(node_id, status, scenario_name, device_id)
+    event.update(fields)
+    await r.publish(FLOW_EVENTS_CHANNEL, json.dumps(event))
+
+
+def node_event(node_id, status, scenario_name=None, device_id=None):
+    return {
+        "node_id": node_id,
+        "status": status,
+        "scenario": scenario_name,
+        "device_id": device_id,
+        "timestamp": time.time(),
+    }
+
+
+async def keep_gateway_registered():
+    """Announce this gateway and the address devices reach it on, while it runs."""
+    key = f"gateway:{GATEWAY_ID}"
+    info = {"host": ADVERTISE_HOST, "port": ADVERTISE_PORT, "started": time.time()}
+    while True:
+        try:
+            pipe = r.pipeline()
+            pipe.hset(key, mapping=info)
+            pipe.expire(key, GATEWAY_TTL)
+            pipe.sadd(GATEWAYS_INDEX, GATEWAY_ID)
+            await pipe.execute()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"An error occurred: {e}")
-            client_socket.close()
-            if num_nodes > 1:
-                for i in range(num_nodes):
-                    remove_device(f"{device_id}_{index+1}")
-            else:
-                remove_device(device_id)
-            break
+            print(f"[!] Gateway registration error: {e}")
+        await asyncio.sleep(GATEWAY_TTL / 3)
+
 
+async def unregister_gateway():
+    pipe = r.pipeline()
+    pipe.delete(f"gateway:{GATEWAY_ID}")
+    pipe.srem(GATEWAYS_INDEX, GATEWAY_ID)
+    await pipe.execute()
 
-def get_device_command(device_id):
+
+async def live_gateways():
+    """{gateway_id: {"host", "port"}} of the gateways whose registration has not expired."""
+    gateway_ids = sorted(await r.smembers(GATEWAYS_INDEX))
+    pipe = r.pipeline()
+    for gateway_id in gateway_ids:
+        pipe.hgetall(f"gateway:{gateway_id}")
+    gateways = {}
+    expired = []
+    for gateway_id, info in zip(gateway_ids, await pipe.execute() if gateway_ids else []):
+        if info:
+            gateways[gateway_id] = {"host": info["host"], "port": int(info["port"])}
+        else:
+            expired.append(gateway_id)
+    if expired:
+        await r.srem(GATEWAYS_INDEX, *expired)
+    return gateways
+
+
+def rendezvous_owner(device_id, gateway_ids):
     """
-    Retrieve the next command for a specific device from Redis.
+    The gateway a device belongs on: highest hash of (gateway, device). Adding or
+    removing a gateway only moves the devices that belong on it.
     """
-    return r.lpop(f"{device_id}:commands")
+    return max(
+        gateway_ids, key=lambda gateway_id: hashlib.sha256(f"{gateway_id}/{device_id}".encode()).digest()
+    )
 
 
-def update_device_info(device_id, device_info):
+async def place_device(node_device_ids, redirected=False):
     """
-    Update the device information in the connected_devices dictionary.
+    Decide where a connecting device is served. Returns None if it is served
+    here, with its leases taken, else the {"gateway_id", "host", "port"} of the
+    gateway to redirect it to. A device that was redirected here is not
+    redirected again unless its lease belongs to another live gateway.
+
+    The leases are taken in a WATCH/MULTI transaction, and only if they are free,
+    already ours or held by a dead gateway: of two gateways placing the device at
+    once, one takes them and the other sees them taken when it tries again.
+    """
+    device_id = node_device_ids[0]
+    keys = [f"device_owner:{node_device_id}" for node_device_id in node_device_ids]
+    while True:
+        async with r.pipeline() as pipe:
+            try:
+                await pipe.watch(*keys)
+                owners = await pipe.mget(keys)
+                previous_owners = {owner for owner in owners if owner and owner != GATEWAY_ID}
+                if previous_owners or owners[0] != GATEWAY_ID:
+                    gateways = await live_gateways()
+                    for owner in owners:
+                        if owner in previous_owners and owner in gateways:
+                            return dict(gateways[owner], gateway_id=owner)
+                    if owners[0] != GATEWAY_ID and not redirected:
+                        best = rendezvous_owner(device_id, set(gateways) | {GATEWAY_ID})
+                        if best != GATEWAY_ID:
+                            return dict(gateways[best], gateway_id=best)
+                pipe.multi()
+                for key in keys:
+                    pipe.set(key, GATEWAY_ID, ex=LEASE_TTL)
+                await pipe.execute()
+            except WatchError:
+                continue  # a lease changed meanwhile: decide again
+        break
+    for owner in previous_owners:
+        print(f"Taking {device_id} over from gateway {owner}, which is gone")
+        await take_over_commands(node_device_ids, owner)
+    return None
+
+
+async def take_over_commands(device_ids, previous_owner):
+    """
+    Claim the commands a dead gateway left pending for these devices right away,
+    instead of after CLAIM_IDLE; the new session reads them first.
+    """
+    for device_id in device_ids:
+        key = f"{device_id}:commands"
+        try:
+            pending = await r.xpending_range(
+                key, COMMANDS_GROUP, min="-", max="+", count=1000, consumername=previous_owner
+            )
+        except ResponseError:
+            continue  # no stream or group yet: nothing pending
+        entry_ids = [entry["message_id"] for entry in pending]
+        if entry_ids:
+            await r.xclaim(key, COMMANDS_GROUP, GATEWAY_ID, 0, entry_ids, justid=True)
+
+
+async def renew_leases(device_ids):
+    """
+    Extend this gateway's leases; raises LeaseLost if another gateway took one.
+    Renewed in a WATCH/MULTI transaction, so a lease taken between the check and
+    the write is never taken back.
+    """
+    keys = [f"device_owner:{device_id}" for device_id in device_ids]
+    if not keys:
+        return
+    while True:
+        async with r.pipeline() as pipe:
+            try:
+                await pipe.watch(*keys)
+                owners = await pipe.mget(keys)
+                for owner in owners:
+                    if owner is not None and owner != GATEWAY_ID:
+                        raise LeaseLost(f"now owned by gateway {owner}")
+                pipe.multi()
+                for key in keys:
+                    pipe.set(key, GATEWAY_ID, ex=LEASE_TTL)
+                await pipe.execute()
+                return
+            except WatchError:
+                continue  # a lease changed meanwhile: check it again
+
+
+async def release_leases(device_ids):
+    """Drop the leases this gateway still holds, so the devices are placed afresh."""
+    keys = [f"device_owner:{device_id}" for device_id in device_ids]
+    if not keys:
+        return
+    async with r.pipeline() as pipe:
+        try:
+            await pipe.watch(*keys)
+            owners = await pipe.mget(keys)
+            pipe.multi()
+            for key, owner in zip(keys, owners):
+                if owner == GATEWAY_ID:
+                    pipe.delete(key)
+            await pipe.execute()
+        except WatchError:
+            pass  # taken over meanwhile: nothing left to release
+
+
+async def update_device_info(device_id, device_info):
+    """
+    Add or update one device in the registry.
     """
     connected_devices[device_id] = device_info
-    print(f"Updated device info: {connected_devices}")
-    r.set(name="connected_devices", value=json.dumps(connected_devices))
+    print(f"Updated device info: {device_id} {device_info}")
+    pipe = r.pipeline()
+    pipe.set(f"device:{device_id}", json.dumps(device_info), ex=DEVICE_TTL)
+    pipe.sadd(DEVICES_INDEX, device_id)
+    pipe.publish(DEVICE_EVENTS_CHANNEL, json.dumps({"event": "updated", "device_id": device_id}))
+    await pipe.execute()
+
+
+async def set_device_health(device_ids, fields):
+    """
+    Update the `device_health:<id>` hashes kept next to the registry entries.
+    """
+    pipe = r.pipeline()
+    for device_id in device_ids:
+        pipe.hset(f"device_health:{device_id}", mapping=fields)
+        pipe.expire(f"device_health:{device_id}", DEVICE_TTL)
+    await pipe.execute()
+
+
+async def refresh_devices(device_ids):
+    """
+    Push back the expiry of registry entries that are still connected.
+    """
+    pipe = r.pipeline()
+    for device_id in device_ids:
+        pipe.expire(f"device:{device_id}", DEVICE_TTL)
+        pipe.expire(f"device_health:{device_id}", DEVICE_TTL)
+    await pipe.execute()
 
 
-def remove_device(device_id):
+async def remove_device(device_id):
     """
-    Remove the device from the connected_devices dictionary and Redis.
+    Remove the device from the registry.
     """
     if device_id in connected_devices:
         del connected_devices[device_id]
-        r.set(name="connected_devices", value=str(connected_devices))
+        pipe = r.pipeline()
+        pipe.delete(f"device:{device_id}")
+        pipe.delete(f"device_health:{device_id}")
+        pipe.srem(DEVICES_INDEX, device_id)
+        pipe.publish(
+            DEVICE_EVENTS_CHANNEL, json.dumps({"event": "removed", "device_id": device_id})
+        )
+        await pipe.execute()
         print(f"Removed device {device_id} from connected devices.")
     else:
         print(f"Device {device_id} not found in connected devices.")
@@ -133,9 +983,7 @@ def remove_device(device_id):
 
 if __name__ == "__main__":
     try:
-        start_server(HOST, PORT)
+        asyncio.run(start_server(HOST, PORT))
     except Exception as e:
         print(f"An error occurred while starting the server: {e}")
-        connected_devices = {}
-        r.set(name="connected_devices", value=str(connected_devices))
         print("Server stopped.")
@@ -0,0 +1,24 @@
+"""
+The device clients and the gateway each ship their own copy of the modules they
+share, so that every folder deploys on its own. This checks the copies match;
+run with `python -m pytest` from the repository root.
+"""
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent
+CLIENTS = ("epaper_client", "generic_device", "monitor_client")
+SHARED_MODULES = {
+    "protocol.py": [ROOT / "tcp_server"] + [ROOT / "client_device" / client for client in CLIENTS],
+    "asset_cache.py": [ROOT / "client_device" / client for client in CLIENTS],
+    "device_runtime.py": [ROOT / "client_device" / client for client in CLIENTS],
+}
+
+
+@pytest.mark.parametrize("name", sorted(SHARED_MODULES))
+def test_copies_are_identical(name):
+    copies = [folder / name for folder in SHARED_MODULES[name]]
+    reference = copies[0].read_bytes()
+    differing = [str(copy.relative_to(ROOT)) for copy in copies[1:] if copy.read_bytes() != reference]
+    assert not differing, f"{', '.join(differing)} differ from {copies[0].relative_to(ROOT)}"